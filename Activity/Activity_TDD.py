@@ -9,6 +9,10 @@ Saves results into SQLite database and produces a CSV report:
 
 Usage:
   python process_logs.py /path/to/log1 /path/to/log2 --db processed_calls.db --report report.csv
+  python process_logs.py /var/log/gateway --workers 8
+  python process_logs.py query top-endpoints --db processed_calls.db --since 2024-03-01 --limit 20
+  python process_logs.py query histogram --bucket hour --endpoint /new/endpoint05/
+  (a log file literally named 'query' has to be given as ./query)
 
 Notes & heuristics (because log format isn't provided):
  - Endpoints are detected by regex looking for '/old/endpoint\d{2}' or '/new/endpoint\d{2}'.
@@ -20,32 +24,124 @@ Notes & heuristics (because log format isn't provided):
  - Query parameters after '?' are parsed into key=value pairs. Parameters without '=' become keys with empty value.
  - Username is searched by looking for tokens like user=, username=, "user": "..." or email-like substring. Fallback to 'unknown'.
  - Datetime: several common timestamp patterns attempted (ISO 8601, Apache-style, RFC-ish). Stored in DB as ISO-8601 text.
+   Each call also gets call_epoch (UTC epoch seconds) and call_date (UTC 'YYYY-MM-DD'), whatever the log format;
+   the report groups by call_date, and date-range queries use idx_call_epoch / idx_call_date_endpoint_user.
+   Both are NULL when the timestamp does not parse; the report lists such calls with an empty date.
  - IP: first IPv4-like found in line is used.
+ - --format nginx|jsonl|app reads the fields of a known layout from their fixed positions (json.loads for
+   jsonl) instead of searching the line with the heuristics above; lines that do not fit the layout still go
+   through the heuristics (counted as format_fallback). --format auto picks the format most of the first
+   FORMAT_DETECT_LINES lines of each file fit, and keeps the heuristics for mixed or unknown files.
  - Multi-line calls: If the same (username, ip, endpoint) pair appears with timestamps within a short window (default 30s), multiple lines are merged into a single call, aggregating parameters. This is a heuristic to handle calls split across lines.
+   Open calls are closed by an event-time watermark (newest log timestamp minus --allowed-lateness, default 10s),
+   so replaying old logs merges exactly like processing them live.
  - Performance: file streaming, batch DB inserts, indexes on call table for report.
+   The report reads call_daily_summary, a (username, date, endpoint) rollup that CallWriter updates in the
+   same transaction as the calls (and builds once from the call table for older DBs).
+   --bulk-load switches the connection to WAL with synchronous=OFF, a large cache and mmap, commits in
+   large transactions, and builds the secondary indexes (then ANALYZE) only after the load.
+ - --columnar-dir writes the call and call_parameters batches also as Parquet (or Arrow IPC, --columnar-format)
+   files partitioned by date and endpoint, with dictionary-encoded user/ip/parameter-name columns (needs pyarrow).
+ - --normalized-schema (new DBs) keeps usernames, endpoints and parameter names in user_dim / endpoint_dim /
+   param_name_dim and stores their ids in call_fact / call_parameter_fact; call and call_parameters become
+   views with the usual columns.
+ - --partition day|month (new DBs) stores the calls and their parameters in one pair of tables per UTC day or
+   month of call_date (listed in call_partition, each with the call indexes); call and call_parameters are
+   UNION ALL views over them. --retain-days N drops whole partitions older than N days before the newest
+   call, ignoring calls dated after tomorrow (DROP TABLE instead of a row-by-row DELETE that leaves the file
+   bloated), and their rollup rows.
+ - Instrumentation: per-stage timings (read, match, extract, merge, flush, db_insert, ...) and counters are
+   printed at the end, progress lines go to stderr every --progress-interval seconds, --stats-json saves both.
+ - Rollups (SUMMARY_TABLES: calls per user/date/endpoint, per date/hour/endpoint, per date/ticker/endpoint) are
+   updated with every commit; the 'query' subcommand (top endpoints, users, tickers, time histograms) reads them
+   through a read-only connection.
+ - Call ids are reserved in id_allocator inside the writing transaction, so a batch's calls and parameters are
+   written together and concurrent writers to one DB never hand out the same id.
+ - Parallelism: --workers N splits the input into byte-range shards (cut on newline boundaries) and runs
+   extraction/normalization in a process pool. Merging and DB writes stay in the main process and consume
+   the shards in order, so the result is identical to a serial run.
+ - --merge-shards N moves the merging to N processes, each owning the open calls whose (username, ip,
+   endpoint) hashes to it and expiring them against the global watermark; the main process only routes
+   lines. Every key sees its lines in order, so the calls are the same as with one merge buffer, although
+   they are written (and numbered) in a different order.
+ - --dedup drops calls identical (user, ip, endpoint, time, parameters) to a stored one, e.g. from replayed
+   or overlapping logs, as they are written: a scalable Bloom filter of the stored fingerprints clears most
+   calls in memory, the call_fingerprint table (its primary key) settles the rest, so no DELETE ... GROUP BY
+   pass is needed afterwards. Calls written without --dedup are fingerprinted when it is next used.
+ - --writer-thread moves the SQLite inserts and commits to a dedicated thread behind a bounded queue, so
+   parsing and merging continue while SQLite writes (sqlite3 releases the GIL during statement execution);
+   the parser blocks when the writer falls WRITER_QUEUE_BATCHES batches behind.
+ - --mmap memory-maps each input and finds candidate lines with a bytes regex; only those lines are decoded.
+   Non-matching lines (the vast majority) are never turned into str objects.
+ - Compressed inputs (gzip, bz2, xz, zstd; detected by magic bytes, zstd needs the 'zstandard' package) are
+   decompressed as a stream. --decompress-thread runs the decompressor on a read-ahead thread.
+ - --incremental keeps per-file checkpoints (path, inode, size, mtime, offset, hash of the first bytes) in
+   ingest_checkpoint and only reads appended data and new rotations; a rotation compressed after it was
+   read (app.log -> app.log.1.gz) is recognized by the hash and read from the old offset. Calls still open at the end of a run are kept in open_call and
+   merged into on the next run; the report includes them. Checkpoints and open calls are committed in the
+   same transaction as the calls they account for, so a run that dies part-way leaves the DB as it was.
+ - --follow tails the (plain) inputs like `tail -F`, handling rotation and truncation, and commits calls in
+   micro-batches every --commit-interval seconds. Stop it with Ctrl-C / SIGTERM; the report is written then.
+   Combined with --incremental it first catches up from the checkpoints, then saves them (and the open
+   calls) with every micro-batch commit.
 
 Author: ChatGPT
 """
 
 import argparse
+import bz2
+import functools
+import gzip
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import locale
+import lzma
+import math
+import mmap
+import multiprocessing
 import os
+import queue
 import re
+import signal
 import sqlite3
+import struct
 import sys
 import csv
+import threading
 import time
-from datetime import datetime, timedelta
-from collections import defaultdict, deque
+import urllib.parse
+import zlib
+from datetime import date, datetime, timedelta, timezone
+from collections import Counter, defaultdict, deque
+
+try:
+    import zstandard  # optional: only needed for .zst inputs
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow as pa  # optional: only needed for --columnar-dir
+    import pyarrow.ipc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
 
 # ---------------------------
 # Configurable heuristics
 # ---------------------------
 MERGE_WINDOW_SECONDS = 30  # lines within this window for same (user, ip, endpoint) are merged into same call
+ALLOWED_LATENESS_SECONDS = 10  # how far a line may lag the newest log timestamp and still merge into its call
 DB_BATCH_SIZE = 1000       # insert per batch
+COLUMNAR_ROWS_PER_FILE = 100000   # --columnar-dir: a partition is written out once it holds this many calls
+COLUMNAR_BUFFER_ROWS = 1000000    # ... and every partition once all of them together hold this many
 # ---------------------------
 
 # Regexes
 RE_ENDPOINT = re.compile(r'/(?:old|new)/endpoint\d{1,3}(?:/[^?\s"]*)*')  # find candidate path
+RE_ENDPOINT_BYTES = re.compile(RE_ENDPOINT.pattern.encode('ascii'))  # same, for --mmap byte scanning
 RE_IPV4 = re.compile(r'\b(?:[0-9]{1,3}\.){3}[0-9]{1,3}\b')
 RE_USER_KV = re.compile(r'(?:user(?:name)?|usr|u)=["\']?([A-Za-z0-9_.@+-]+)["\']?', re.IGNORECASE)
 RE_USER_JSON = re.compile(r'["\']user(?:name)?["\']\s*:\s*["\']([^"\']+)["\']', re.IGNORECASE)
@@ -68,11 +164,19 @@ def find_username(line):
     m = RE_USER_JSON.search(line)
     if m:
         return m.group(1)
-    m = RE_EMAIL.search(line)
-    if m:
-        return m.group(0)
+    if '@' in line:  # RE_EMAIL is the slowest pattern; it cannot match without one
+        m = RE_EMAIL.search(line)
+        if m:
+            return m.group(0)
     return None
 
+def apache_to_text(text):
+    # convert '10/Oct/2000:13:55:36' -> '2000-10-10 13:55:36'
+    dt = apache_to_dt(text)
+    if dt is None:
+        return None
+    return f"{text[7:11]}-{dt.month:02d}-{text[0:2]} {text[12:20]}"
+
 def parse_timestamp(line):
     # Try patterns in order. Return ISO8601 string (UTC naive) or None
     m = RE_ISO.search(line)
@@ -87,17 +191,18 @@ def parse_timestamp(line):
         return m.group(1)
     m = RE_APACHE.search(line)
     if m:
-        # convert '10/Oct/2000:13:55:36' -> '2000-10-10 13:55:36'
-        try:
-            dt = datetime.strptime(m.group(1), '%d/%b/%Y:%H:%M:%S')
-            return dt.strftime('%Y-%m-%d %H:%M:%S')
-        except Exception:
-            pass
+        ts = apache_to_text(m.group(1))
+        if ts:
+            return ts
     m = RE_SIMPLE.search(line)
     if m:
         return m.group(1)
     return None
 
+def scan_fields(line):
+    # (username, ip, timestamp_text) of a line, by the helpers above
+    return find_username(line), find_first_ip(line), parse_timestamp(line)
+
 def parse_query_params(qs):
     # qs: string after '?', may contain & separated key=val pairs or lone tokens
     params = {}
@@ -179,6 +284,715 @@ def normalize_endpoint_and_params(raw_path):
             params['ticker'] = ticker_value
     return endpoint, params
 
+NORMALIZE_CACHE_SIZE = 65536  # distinct raw paths kept by normalize_cached (least recently used are dropped)
+
+class FrozenParams(dict):
+    # read-only params dict returned by normalize_cached: one object is shared by every line with the same path
+    __slots__ = ()
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("cached params are read-only")
+
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = _read_only
+
+    def __reduce__(self):
+        # picklable for --workers (the default dict pickling would go through __setitem__)
+        return (FrozenParams, (dict(self),))
+
+@functools.lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def normalize_cached(raw_path):
+    """
+    normalize_endpoint_and_params memoized by raw path (the same few paths repeat millions of times).
+    Returns (endpoint, FrozenParams), with the endpoint and parameter names interned.
+    normalize_cached.cache_info() has the hit / miss counts.
+    """
+    endpoint, params = normalize_endpoint_and_params(raw_path)
+    return sys.intern(endpoint), FrozenParams({sys.intern(k): v for k, v in params.items()})
+
+def extract_call(line):
+    """
+    Run the per-line extraction on one log line.
+    Returns (endpoint, params, username, ip, timestamp_text) or None if the line has no endpoint;
+    timestamp_text is None when the line has no recognizable timestamp.
+    """
+    # cheap substring prefilter: RE_ENDPOINT can only match lines containing '/old/' or '/new/'
+    if '/old/' not in line and '/new/' not in line:
+        return None
+    m = RE_ENDPOINT.search(line)
+    if not m:
+        return None
+    return extract_fields(line, m.group(0))
+
+def extract_fields(line, raw_path):
+    # the rest of extract_call, for a line whose endpoint match is raw_path
+    endpoint, params = normalize_cached(raw_path)
+    username, ip, timestamp_text = scan_fields(line)
+    username = username or 'unknown'
+    ip = ip or ''
+    return endpoint, params, username, ip, timestamp_text
+
+# ---------------------------
+# Log format profiles
+# ---------------------------
+# Parsers for the known layouts, by --format name. Each takes a line and returns
+# (raw_path, username, ip, timestamp_text), NOT_A_CALL for a line in its layout whose request is not an
+# endpoint call, or None when the line does not fit the layout (it then goes through the heuristics).
+# Fields come from fixed positions, so text elsewhere in the line (a timestamp in a query string, an email
+# in a user agent) cannot be mistaken for them.
+FORMAT_DETECT_LINES = 1000  # --format auto: lines read from the start of each input to pick its format
+NOT_A_CALL = (None, None, None, None)
+
+# nginx combined: $remote_addr - $remote_user [$time_local] "$request" $status $body_bytes_sent ...
+RE_NGINX = re.compile(r'(\S+) \S+ (\S+) \[([^\]]+)\] "[A-Z]+ ([^ "]+)')
+# app: <timestamp> <ip> {"user": "<name>", ...} <METHOD> <path> <status>
+RE_APP = re.compile(r'(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(?:\.\d+)?(?:Z|[+\-]\d{2}:?\d{2})?'
+                    r'|\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}|\d{4}/\d{2}/\d{2} \d{2}:\d{2}:\d{2}) '
+                    r'(\S+) \{"user(?:name)?": "([^"]*)"[^}]*\} [A-Z]+ (\S+)')
+# jsonl: one JSON object per line; the first present key of each tuple is used
+JSONL_KEYS = {
+    'path': ('path', 'uri', 'request_uri', 'url', 'request'),
+    'username': ('user', 'username', 'remote_user'),
+    'ip': ('ip', 'remote_addr', 'client_ip'),
+    'time': ('time', 'timestamp', '@timestamp', 'time_local', 'ts'),
+}
+
+def parse_nginx(line):
+    m = RE_NGINX.match(line)
+    if m is None:
+        return None
+    ip, remote_user, time_local, target = m.groups()
+    endpoint = RE_ENDPOINT.search(target)
+    if endpoint is None:
+        return NOT_A_CALL
+    # no $remote_user: look for user= and friends like the heuristics do
+    username = remote_user if remote_user != '-' else find_username(line)
+    return endpoint.group(0), username, ip, apache_to_text(time_local[:20])
+
+def parse_app(line):
+    m = RE_APP.match(line)
+    if m is None:
+        return None
+    timestamp_text, ip, username, target = m.groups()
+    endpoint = RE_ENDPOINT.search(target)
+    if endpoint is None:
+        return NOT_A_CALL
+    return endpoint.group(0), username, ip, timestamp_text
+
+def parse_jsonl(line):
+    if not line.lstrip().startswith('{'):
+        return None
+    try:
+        obj = json.loads(line)
+    except ValueError:
+        return None
+    if not isinstance(obj, dict):
+        return None
+    found = {field: next((obj[k] for k in keys if obj.get(k) not in (None, '', '-')), None)
+             for field, keys in JSONL_KEYS.items()}
+    endpoint = RE_ENDPOINT.search(found['path']) if isinstance(found['path'], str) else None
+    if endpoint is None:
+        return NOT_A_CALL
+    ts = found['time']
+    if isinstance(ts, str):
+        timestamp_text = parse_timestamp(ts)
+    elif isinstance(ts, (int, float)) and not isinstance(ts, bool):
+        # epoch seconds
+        try:
+            timestamp_text = datetime.fromtimestamp(ts, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        except (OverflowError, OSError, ValueError):
+            timestamp_text = None
+    else:
+        timestamp_text = None
+    username, ip = found['username'], found['ip']
+    return (endpoint.group(0), None if username is None else str(username), None if ip is None else str(ip),
+            timestamp_text)
+
+LOG_FORMATS = {'nginx': parse_nginx, 'jsonl': parse_jsonl, 'app': parse_app}
+FORMAT_CHOICES = ['heuristic', 'auto'] + list(LOG_FORMATS)
+
+def format_record(fields):
+    # extract_fields for a line a LOG_FORMATS parser has taken apart; None if it is not a call
+    raw_path, username, ip, timestamp_text = fields
+    if raw_path is None:
+        return None
+    endpoint, params = normalize_cached(raw_path)
+    return endpoint, params, username or 'unknown', ip or '', timestamp_text
+
+def detect_log_format(path, n_lines=FORMAT_DETECT_LINES):
+    """
+    The LOG_FORMATS name most of the first n_lines of path fit, or 'heuristic' if no format fits at least
+    half of them (mixed or unknown layouts, an empty or missing file).
+    """
+    try:
+        sample = [line for line in itertools.islice(iter_lines_from_file(path), n_lines) if line.strip()]
+    except OSError:
+        return 'heuristic'
+    fits = Counter(name for line in sample for name, parse in LOG_FORMATS.items() if parse(line) is not None)
+    if fits:
+        name, n = fits.most_common(1)[0]
+        if 2 * n >= len(sample):
+            return name
+    return 'heuristic'
+
+def resolve_log_format(path, log_format):
+    # the format to read path with: log_format itself unless it is 'auto'
+    return detect_log_format(path) if log_format == 'auto' else log_format
+
+def extract_records(lines, stats=None, log_format='heuristic'):
+    """
+    Extract calls from an iterable of lines.
+    Returns (line_count, records); each record is (line_number, endpoint, params, username, ip, timestamp_text)
+    with line_number counted from 1 within `lines`.
+    Runs as three passes (read the lines, find endpoint matches, extract fields from the matches) so each can
+    be timed into stats (a StageStats) with a few clock reads per call rather than per line.
+    log_format names the LOG_FORMATS parser for the extract pass; matched lines it cannot parse (counted as
+    'format_fallback') and the 'heuristic' format use extract_fields.
+    """
+    t0 = time.perf_counter()
+    lines = lines if isinstance(lines, list) else list(lines)
+    t1 = time.perf_counter()
+    search = RE_ENDPOINT.search
+    matches = []
+    for line_no, line in enumerate(lines, 1):
+        # cheap substring prefilter: RE_ENDPOINT can only match lines containing '/old/' or '/new/'
+        if '/old/' in line or '/new/' in line:
+            m = search(line)
+            if m:
+                matches.append((line_no, line, m.group(0)))
+    t2 = time.perf_counter()
+    parse = LOG_FORMATS.get(log_format)
+    fallbacks = 0
+    if parse is None:
+        records = [(line_no,) + extract_fields(line, raw_path) for line_no, line, raw_path in matches]
+    else:
+        records = []
+        for line_no, line, raw_path in matches:
+            fields = parse(line)
+            if fields is None:
+                fallbacks += 1
+                records.append((line_no,) + extract_fields(line, raw_path))
+            elif fields[0] is not None:
+                records.append((line_no,) + format_record(fields))
+    if stats is not None:
+        stats.add('read', t1 - t0)
+        stats.add('match', t2 - t1)
+        stats.add('extract', time.perf_counter() - t2)
+        stats.count('lines', len(lines))
+        stats.count('bytes', sum(map(len, lines)))  # characters of decoded text; bytes for ASCII logs
+        if fallbacks:
+            stats.count('format_fallback', fallbacks)
+    return len(lines), records
+
+def iter_text_record_chunks(lines, stats=None, log_format='heuristic'):
+    # extract_records over SERIAL_CHUNK_LINES-line chunks of a line iterator
+    while True:
+        line_count, records = extract_records(itertools.islice(lines, SERIAL_CHUNK_LINES), stats, log_format)
+        if not line_count:
+            return
+        yield line_count, records
+
+# ---------------------------
+# Pipeline statistics
+# ---------------------------
+PROGRESS_SECONDS = 10.0  # default seconds between progress lines on stderr (0 turns them off)
+STAGES = ('read', 'match', 'extract', 'wait', 'merge', 'merge_wait', 'flush', 'writer_wait', 'dedup', 'db_insert', 'columnar',
+          'report')
+
+class StageStats:
+    """
+    Seconds spent per pipeline stage plus running counters (lines, bytes, calls, db_rows, and normalize_hits /
+    normalize_misses: normalize_cached lookups of this run, see count_normalize_cache).
+     - read / match / extract: reading (and decoding / decompressing) lines, finding endpoint matches,
+       extracting fields from the matched lines; summed over worker processes with --workers
+     - wait: main process waiting for --workers results
+     - merge: merging records into open calls; flush: closing expired open calls; db_insert: writing and
+       committing call batches (including the --bulk-load index rebuild); columnar: --columnar-dir output;
+       report: writing the CSV report
+     - merge_wait: with --merge-shards, time spent waiting for the merge shard processes (merge is then
+       only the routing of the lines to them)
+     - dedup: with --dedup, fingerprinting the batches and dropping the calls already stored
+     - writer_wait: with --writer-thread, time the main loop was blocked handing work to the writer thread
+       (db_insert and columnar then run on that thread, overlapping the other stages)
+    Picklable, so workers can send theirs back with their records.
+    """
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.counters = defaultdict(int)
+
+    def add(self, stage, seconds):
+        self.seconds[stage] += seconds
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def merge(self, other):
+        for stage, seconds in other.seconds.items():
+            self.seconds[stage] += seconds
+        for name, n in other.counters.items():
+            self.counters[name] += n
+
+    def as_dict(self, elapsed):
+        lines, nbytes, db_rows = self.counters['lines'], self.counters['bytes'], self.counters['db_rows']
+        return {
+            'elapsed_seconds': round(elapsed, 3),
+            'counters': dict(self.counters),
+            'lines_per_sec': round(lines / elapsed, 1) if elapsed else None,
+            'mb_per_sec': round(nbytes / 1e6 / elapsed, 3) if elapsed else None,
+            'db_rows_per_sec': round(db_rows / elapsed, 1) if elapsed else None,
+            'stage_seconds': {stage: round(self.seconds[stage], 3) for stage in STAGES if stage in self.seconds},
+        }
+
+    def progress_line(self, elapsed, open_calls):
+        d = self.as_dict(elapsed)
+        return (f"[{elapsed:7.1f}s] {self.counters['lines']} lines ({d['lines_per_sec']:,.0f}/s, "
+                f"{d['mb_per_sec']:.1f} MB/s), {open_calls} open calls, "
+                f"{self.counters['db_rows']} calls written ({d['db_rows_per_sec']:,.0f}/s)")
+
+    def summary_line(self):
+        return "Stage seconds: " + ", ".join(f"{stage} {self.seconds[stage]:.2f}"
+                                             for stage in STAGES if stage in self.seconds)
+
+# ---------------------------
+# Input files and shards
+# ---------------------------
+SERIAL_CHUNK_LINES = 10000           # lines extracted per chunk in serial mode
+SHARD_SIZE_BYTES = 64 * 1024 * 1024  # byte-range shard size for --workers mode
+NEWLINE_COUNT_BLOCK = 16 * 1024 * 1024  # bytes copied at a time when counting skipped lines in --mmap mode
+TEXT_ENCODING = locale.getpreferredencoding(False)  # what open(path, 'r') decodes with
+DECOMPRESS_CHUNK_BYTES = 4 * 1024 * 1024  # read size for compressed inputs
+READAHEAD_BLOCKS = 8                      # decompressed blocks the --decompress-thread may run ahead
+FOLLOW_POLL_SECONDS = 0.2                 # --follow: sleep between polls when no file has new data
+FOLLOW_COMMIT_SECONDS = 1.0               # --follow: max time new calls wait before being committed
+FOLLOW_READ_BYTES = 4 * 1024 * 1024       # --follow: max bytes read from one file per poll
+CHECKPOINT_HEAD_BYTES = 4096              # --incremental: leading bytes hashed to recognize a file once compressed
+
+# magic bytes -> compression name
+COMPRESSION_MAGIC = [
+    (b'\x1f\x8b', 'gzip'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+]
+
+def iter_input_files(paths):
+    # expand directories (one level, sorted) and skip anything that is not a file
+    for p in paths:
+        if os.path.isdir(p):
+            for fname in sorted(os.listdir(p)):
+                fpath = os.path.join(p, fname)
+                if os.path.isfile(fpath):
+                    yield fpath
+        elif os.path.isfile(p):
+            yield p
+        else:
+            print(f"Warning: {p} is not a file or directory, skipping.", file=sys.stderr)
+
+def detect_compression(path):
+    # sniff the magic bytes; None means a plain file
+    with open(path, 'rb') as fh:
+        head = fh.read(6)
+    for magic, name in COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            return name
+    return None
+
+class ReadAheadReader(io.RawIOBase):
+    """
+    Raw stream that reads DECOMPRESS_CHUNK_BYTES blocks from `source` on a background thread, up to
+    READAHEAD_BLOCKS ahead of the consumer, so decompression overlaps with regex work.
+    (zlib, bz2 and lzma release the GIL while decompressing.)
+    """
+    def __init__(self, source, depth=READAHEAD_BLOCKS):
+        super().__init__()
+        self.source = source
+        self.blocks = queue.Queue(maxsize=depth)
+        self.stopping = threading.Event()
+        self.pending = memoryview(b'')
+        self.eof = False
+        self.thread = threading.Thread(target=self._fill, daemon=True)
+        self.thread.start()
+
+    def _fill(self):
+        try:
+            while not self.stopping.is_set():
+                block = self.source.read(DECOMPRESS_CHUNK_BYTES)
+                self._put(block)
+                if not block:
+                    return
+        except Exception as exc:  # handed to the reading thread
+            self._put(exc)
+
+    def _put(self, item):
+        while not self.stopping.is_set():
+            try:
+                self.blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self.pending:
+            if self.eof:
+                return 0
+            item = self.blocks.get()
+            if isinstance(item, Exception):
+                raise item
+            if not item:
+                self.eof = True
+                return 0
+            self.pending = memoryview(item)
+        n = min(len(b), len(self.pending))
+        b[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.stopping.set()
+            self.thread.join()
+            self.source.close()
+        super().close()
+
+def open_decompressed(path, compression):
+    if compression == 'gzip':
+        return gzip.open(path, 'rb')
+    if compression == 'bz2':
+        return bz2.open(path, 'rb')
+    if compression == 'xz':
+        return lzma.open(path, 'rb')
+    if compression == 'zstd':
+        if zstandard is None:
+            raise RuntimeError(f"{path} is zstd-compressed; install the 'zstandard' package to read it")
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+    raise ValueError(f"unknown compression {compression!r}")
+
+def read_head(fh):
+    # the first CHECKPOINT_HEAD_BYTES of a binary stream (fewer if it is shorter)
+    head = b''
+    while len(head) < CHECKPOINT_HEAD_BYTES:
+        block = fh.read(CHECKPOINT_HEAD_BYTES - len(head))
+        if not block:
+            break
+        head += block
+    return head
+
+def head_hash(head):
+    return hashlib.blake2b(head, digest_size=16).hexdigest()
+
+def iter_lines_from_file(path, readahead=False, skip=0):
+    """
+    Yield decoded lines from a plain or compressed log. Compression is detected from the magic bytes and
+    decoded as a stream; with readahead a background thread decompresses ahead of the parser.
+    skip: decompressed bytes to pass over first (compressed input only; see plan_incremental_ranges).
+    """
+    compression = detect_compression(path)
+    if compression is None:
+        with open(path, 'r', errors='ignore') as fh:
+            for line in fh:
+                yield line
+        return
+    source = open_decompressed(path, compression)
+    if readahead:
+        source = ReadAheadReader(source)
+    buffered = io.BufferedReader(source, buffer_size=DECOMPRESS_CHUNK_BYTES)
+    while skip > 0:
+        block = buffered.read(min(skip, DECOMPRESS_CHUNK_BYTES))
+        if not block:
+            break
+        skip -= len(block)
+    with io.TextIOWrapper(buffered, errors='ignore') as fh:
+        for line in fh:
+            yield line
+
+def plan_shards(path, shard_size=SHARD_SIZE_BYTES, start=0, end=None):
+    """
+    Split path[start:end] into (path, start, end) byte ranges. Every range except the last ends right after
+    a newline, so no line is cut in two and the shards together read exactly like the whole range.
+    Compressed files cannot be split and become a single (path, start, None) shard, start counting
+    decompressed bytes.
+    """
+    if detect_compression(path) is not None:
+        return [(path, start, None)]
+    size = os.path.getsize(path) if end is None else end
+    shards = []
+    with open(path, 'rb') as fh:
+        while start < size:
+            stop = start + shard_size
+            if stop >= size:
+                stop = size
+            else:
+                fh.seek(stop)
+                fh.readline()  # move to the end of the line we landed in
+                stop = min(fh.tell(), size)
+            shards.append((path, start, stop))
+            start = stop
+    return shards
+
+class RangeReader(io.RawIOBase):
+    # raw stream over bytes [start, end) of an open binary file
+    def __init__(self, fh, start, end):
+        super().__init__()
+        self.fh = fh
+        self.remaining = end - start
+        fh.seek(start)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.remaining <= 0:
+            return 0
+        n = self.fh.readinto(memoryview(b)[:self.remaining])
+        self.remaining -= n
+        return n
+
+def iter_lines_from_range(path, start, end):
+    # decode exactly like iter_lines_from_file (default encoding, errors='ignore', universal newlines)
+    with open(path, 'rb') as fh:
+        with io.TextIOWrapper(io.BufferedReader(RangeReader(fh, start, end)), errors='ignore') as text:
+            for line in text:
+                yield line
+
+def count_newlines(buf, start, end):
+    # count b'\n' in buf[start:end] without copying the whole range at once
+    count = 0
+    while start < end:
+        stop = min(end, start + NEWLINE_COUNT_BLOCK)
+        count += buf[start:stop].count(b'\n')
+        start = stop
+    return count
+
+def iter_mmap_record_chunks(path, start=0, end=None, stats=None, log_format='heuristic'):
+    """
+    Bytes-mode extraction over path[start:end] for --mmap.
+    The file is memory-mapped and scanned with RE_ENDPOINT_BYTES; only lines holding a candidate endpoint
+    are decoded and passed to extract_call (or the log_format parser), the rest are just counted. Yields (line_count, records) chunks
+    like iter_record_chunks. Unlike text mode, a lone '\r' does not end a line here.
+    In stats, reading the file happens inside the byte scan (page faults), so it is all counted as 'match'.
+    """
+    if end is None:
+        end = os.path.getsize(path)
+    if start >= end:
+        return
+    parse = LOG_FORMATS.get(log_format)
+    with open(path, 'rb') as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        pos = start     # first byte not yet counted; always at a line start
+        line_count = 0
+        records = []
+        chunk_start, chunk_pos, extract_seconds, fallbacks = time.perf_counter(), pos, 0.0, 0
+
+        def chunk_stats(line_count):
+            if stats is not None:
+                stats.add('match', time.perf_counter() - chunk_start - extract_seconds)
+                stats.add('extract', extract_seconds)
+                stats.count('lines', line_count)
+                stats.count('bytes', pos - chunk_pos)
+                if fallbacks:
+                    stats.count('format_fallback', fallbacks)
+
+        while True:
+            m = RE_ENDPOINT_BYTES.search(mm, pos, end)
+            if not m:
+                break
+            nl = mm.rfind(b'\n', pos, m.start())
+            line_start = pos if nl < 0 else nl + 1
+            nl = mm.find(b'\n', m.end(), end)
+            line_end = end if nl < 0 else nl + 1
+            line_no = line_count + count_newlines(mm, pos, line_start) + 1
+            line = mm[line_start:line_end].decode(TEXT_ENCODING, 'ignore')
+            if line.endswith('\r\n'):
+                line = line[:-2] + '\n'
+            t = time.perf_counter()
+            fields = parse(line) if parse is not None else None
+            if fields is None:
+                fallbacks += parse is not None
+                found = extract_call(line)
+            else:
+                found = format_record(fields)
+            extract_seconds += time.perf_counter() - t
+            if found:
+                records.append((line_no,) + found)
+            line_count = line_no
+            pos = line_end
+            if line_count >= SERIAL_CHUNK_LINES:
+                chunk_stats(line_count)
+                yield line_count, records
+                line_count, records = 0, []
+                chunk_start, chunk_pos, extract_seconds, fallbacks = time.perf_counter(), pos, 0.0, 0
+        line_count += count_newlines(mm, pos, end)
+        if pos < end and mm[end - 1:end] != b'\n':
+            line_count += 1  # last line has no trailing newline
+        pos = end
+        chunk_stats(line_count)
+        if line_count:
+            yield line_count, records
+
+def count_normalize_cache(stats, before):
+    # add the normalize_cached hits / misses since `before` (a cache_info() of this process) to stats;
+    # the cache and its counts are per process and cumulative, so runs and workers report deltas
+    after = normalize_cached.cache_info()
+    stats.count('normalize_hits', after.hits - before.hits)
+    stats.count('normalize_misses', after.misses - before.misses)
+
+def scan_shard(shard, use_mmap=False, readahead=False):
+    # worker entry point for --workers mode; must stay module-level so it can be pickled.
+    # shard is (path, start, end, log_format). Returns (line_count, records, stats) for the whole shard.
+    path, start, end, log_format = shard
+    stats = StageStats()
+    cache_before = normalize_cached.cache_info()
+    if end is None:
+        chunks = iter_text_record_chunks(iter_lines_from_file(path, readahead, start), stats, log_format)
+    elif use_mmap:
+        chunks = iter_mmap_record_chunks(path, start, end, stats, log_format)
+    else:
+        chunks = iter_text_record_chunks(iter_lines_from_range(path, start, end), stats, log_format)
+    total, records = 0, []
+    for line_count, chunk in chunks:
+        records.extend((total + r[0],) + r[1:] for r in chunk)
+        total += line_count
+    count_normalize_cache(stats, cache_before)
+    return total, records, stats
+
+def iter_record_chunks(paths, workers=1, shard_size=SHARD_SIZE_BYTES, use_mmap=False, readahead=False,
+                       ranges=None, stats=None, log_format='heuristic'):
+    """
+    Yield (line_count, records) chunks in input order.
+    `ranges` is a list of (path, start, end) to read instead of whole files (end None means to EOF; a
+    compressed file's start counts decompressed bytes); by default every input file is read completely.
+    With workers > 1, files are split into byte-range shards and extracted by a process pool;
+    imap keeps the results in shard order so the merge step sees the same stream as a serial run.
+    use_mmap switches plain files (or shards) to the bytes-mode reader, iter_mmap_record_chunks;
+    compressed files are always streamed through iter_lines_from_file.
+    stats (a StageStats) collects per-stage times and line / byte counts; with workers > 1 the read / match /
+    extract times are summed over the worker processes and 'wait' is the time spent waiting for them.
+    log_format is a FORMAT_CHOICES name; 'auto' picks one per file with detect_log_format.
+    """
+    if ranges is None:
+        ranges = [(path, 0, None) for path in iter_input_files(paths)]
+    formats = {path: resolve_log_format(path, log_format) for path in dict.fromkeys(r[0] for r in ranges)}
+    if workers <= 1:
+        for path, start, end in ranges:
+            compressed = detect_compression(path) is not None
+            if use_mmap and not compressed:
+                yield from iter_mmap_record_chunks(path, start, end, stats, formats[path])
+                continue
+            if compressed or (start == 0 and end is None):
+                lines = iter_lines_from_file(path, readahead, start if compressed else 0)
+            else:
+                lines = iter_lines_from_range(path, start, os.path.getsize(path) if end is None else end)
+            yield from iter_text_record_chunks(lines, stats, formats[path])
+        return
+    shards = [s + (formats[path],) for path, start, end in ranges for s in plan_shards(path, shard_size, start, end)]
+    with multiprocessing.Pool(workers) as pool:
+        results = pool.imap(functools.partial(scan_shard, use_mmap=use_mmap, readahead=readahead), shards)
+        while True:
+            t = time.perf_counter()
+            shard_result = next(results, None)
+            if stats is not None:
+                stats.add('wait', time.perf_counter() - t)
+            if shard_result is None:
+                return
+            line_count, records, shard_stats = shard_result
+            if stats is not None:
+                stats.merge(shard_stats)
+            yield line_count, records
+
+class TailedFile:
+    """
+    One input in --follow mode, tailed like `tail -F`: only complete lines are returned, a rotated path
+    (new inode) is reopened from the start once the old file is drained, a truncated file is re-read from
+    the start, and a missing file is picked up when it appears.
+    offset None starts at the current end of the file. log_format is the FORMAT_CHOICES name its lines are
+    parsed with ('auto' is detected once, here).
+    """
+    def __init__(self, path, offset=None, log_format='heuristic'):
+        self.path = path
+        self.log_format = resolve_log_format(path, log_format)
+        self.fh = None
+        self.ino = None
+        self.pending = b''  # trailing partial line
+        self._open(offset)
+
+    def _open(self, offset):
+        try:
+            fh = open(self.path, 'rb')
+        except FileNotFoundError:
+            self.fh = None
+            return
+        st = os.fstat(fh.fileno())
+        if offset is None or offset > st.st_size:
+            offset = st.st_size if offset is None else 0
+        fh.seek(offset)
+        self.fh, self.ino, self.pending = fh, st.st_ino, b''
+
+    def _drain(self):
+        data = self.fh.read(FOLLOW_READ_BYTES)
+        if not data:
+            return []
+        data = self.pending + data
+        cut = data.rfind(b'\n') + 1
+        self.pending = data[cut:]
+        return [line.decode(TEXT_ENCODING, 'ignore') + '\n' for line in data[:cut].split(b'\n')[:-1]]
+
+    def read_lines(self):
+        if self.fh is None:
+            self._open(0)
+            if self.fh is None:
+                return []
+        lines = self._drain()
+        if lines:
+            return lines
+        # nothing new in the open file: check whether the path now points elsewhere
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return []  # rotated away and not recreated yet
+        if st.st_ino != self.ino:
+            self.fh.close()
+            self._open(0)
+        elif st.st_size < self.fh.tell():
+            self.fh.seek(0)
+            self.pending = b''
+        return self._drain() if self.fh is not None else []
+
+    def checkpoint(self):
+        # ingest_checkpoint row for the data consumed so far
+        st = os.fstat(self.fh.fileno())
+        head = os.pread(self.fh.fileno(), CHECKPOINT_HEAD_BYTES, 0)
+        return (self.path, st.st_ino, st.st_size, st.st_mtime, self.fh.tell() - len(self.pending),
+                head_hash(head) if head else None, len(head))
+
+    def close(self):
+        if self.fh is not None:
+            self.fh.close()
+
+def follow_record_chunks(tailed, stop, poll_interval=FOLLOW_POLL_SECONDS, stats=None):
+    """
+    Yield (line_count, records) chunks from TailedFiles until `stop` (a threading.Event) is set.
+    When no file has new data it sleeps poll_interval and yields (0, []), so the caller still gets a
+    chance to commit on time. Each poll is one chunk (every file's lines parsed with its log_format), so
+    once the caller has merged a chunk, the TailedFile checkpoints cover only lines it has seen.
+    """
+    while not stop.is_set():
+        started = time.perf_counter()
+        batches = [(t.log_format, t.read_lines()) for t in tailed]
+        if stats is not None:
+            stats.add('read', time.perf_counter() - started)
+        if not any(lines for _, lines in batches):
+            stop.wait(poll_interval)
+            yield 0, []
+            continue
+        line_count, records = 0, []
+        for log_format, lines in batches:
+            if lines:
+                n, file_records = extract_records(lines, stats, log_format)
+                records.extend((line_count + record[0],) + record[1:] for record in file_records)
+                line_count += n
+        yield line_count, records
+
 # ---------------------------
 # DB functions
 # ---------------------------
@@ -188,7 +1002,9 @@ CREATE TABLE IF NOT EXISTS call (
     username TEXT,
     date_of_call TEXT,   -- stored as ISO8601 or 'YYYY-MM-DD HH:MM:SS'
     ip_address TEXT,
-    endpoint TEXT
+    endpoint TEXT,
+    call_epoch INTEGER,  -- date_of_call as UTC epoch seconds (see call_time_columns)
+    call_date TEXT       -- UTC 'YYYY-MM-DD'
 );
 """
 
@@ -202,247 +1018,1747 @@ CREATE TABLE IF NOT EXISTS call_parameters (
 );
 """
 
-CREATE_INDEXES = [
-    "CREATE INDEX IF NOT EXISTS idx_call_user_date_endpoint ON call(username, date_of_call, endpoint);",
-    "CREATE INDEX IF NOT EXISTS idx_call_date ON call(date_of_call);"
+# --normalized-schema: endpoint, username and parameter name are stored once in dimension tables and referenced
+# by integer id; call / call_parameters are views with the same columns as the plain tables, so readers
+# (report, ad-hoc queries) do not care which layout a DB uses
+CREATE_NORMALIZED_TABLES = [
+    "CREATE TABLE IF NOT EXISTS user_dim (id INTEGER PRIMARY KEY, username TEXT UNIQUE);",
+    "CREATE TABLE IF NOT EXISTS endpoint_dim (id INTEGER PRIMARY KEY, endpoint TEXT UNIQUE);",
+    "CREATE TABLE IF NOT EXISTS param_name_dim (id INTEGER PRIMARY KEY, parameter_name TEXT UNIQUE);",
+    """
+    CREATE TABLE IF NOT EXISTS call_fact (
+        ID INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER REFERENCES user_dim(id),
+        date_of_call TEXT,
+        ip_address TEXT,
+        endpoint_id INTEGER REFERENCES endpoint_dim(id),
+        call_epoch INTEGER,
+        call_date TEXT
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS call_parameter_fact (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        call_id INTEGER REFERENCES call_fact(ID),
+        parameter_name_id INTEGER REFERENCES param_name_dim(id),
+        parameter_value TEXT
+    );
+    """,
+    """
+    CREATE VIEW IF NOT EXISTS call AS
+    SELECT f.ID, u.username, f.date_of_call, f.ip_address, e.endpoint, f.call_epoch, f.call_date
+    FROM call_fact f JOIN user_dim u ON u.id = f.user_id JOIN endpoint_dim e ON e.id = f.endpoint_id;
+    """,
+    """
+    CREATE VIEW IF NOT EXISTS call_parameters AS
+    SELECT p.id, p.call_id, n.parameter_name, p.parameter_value
+    FROM call_parameter_fact p JOIN param_name_dim n ON n.id = p.parameter_name_id;
+    """,
+]
+
+# --partition (new DBs): call / call_parameters rows go to one pair of tables per UTC day or month of call_date,
+# and call / call_parameters are UNION ALL views over them (see CallPartitions)
+CREATE_PARTITIONING_TABLES = [
+    "CREATE TABLE IF NOT EXISTS call_partitioning (granularity TEXT NOT NULL);",  # one row: 'day' or 'month'
+    """
+    CREATE TABLE IF NOT EXISTS call_partition (
+        suffix TEXT PRIMARY KEY,  -- the tables are call_<suffix> and call_parameters_<suffix>
+        first_date TEXT,          -- first call_date the partition holds (NULL for the undated one)
+        end_date TEXT             -- first call_date after it
+    );
+    """,
+]
+CREATE_PARTITION_TABLES = [
+    """
+    CREATE TABLE IF NOT EXISTS call_{suffix} (
+        ID INTEGER PRIMARY KEY,  -- reserved in id_allocator, unique over all partitions
+        username TEXT,
+        date_of_call TEXT,
+        ip_address TEXT,
+        endpoint TEXT,
+        call_epoch INTEGER,
+        call_date TEXT
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS call_parameters_{suffix} (
+        id INTEGER PRIMARY KEY,  -- reserved in id_allocator too, so the view keeps insertion order
+        call_id INTEGER,
+        parameter_name TEXT,
+        parameter_value TEXT
+    );
+    """,
+]
+PARTITION_GRANULARITIES = {'day': 10, 'month': 7}  # --partition choice -> length of the call_date prefix it keeps
+UNDATED_PARTITION = 'undated'  # calls whose timestamp did not parse (NULL call_date); never dropped
+RETENTION_FUTURE_DAYS = 1  # --retain-days: call dates further ahead of the wall clock are bogus, not the newest call
+VIEW_UNION_TERMS = 400  # SELECTs per UNION ALL in the partition views (SQLite allows at most 500 in one compound)
+
+# --incremental state: how far each input file has been read ...
+CREATE_CHECKPOINT_TABLE = """
+CREATE TABLE IF NOT EXISTS ingest_checkpoint (
+    path TEXT PRIMARY KEY,
+    inode INTEGER,
+    size INTEGER,
+    mtime REAL,
+    offset INTEGER,      -- bytes processed; just past a newline, or the file size for compressed input
+    head_hash TEXT,      -- plain files: head_hash() of the first head_size bytes, to find them again compressed
+    head_size INTEGER
+);
+"""
+
+# ... and the merge buffer (calls that may still get more lines) at the end of the last run
+CREATE_OPEN_CALL_TABLE = """
+CREATE TABLE IF NOT EXISTS open_call (
+    username TEXT,
+    ip_address TEXT,
+    endpoint TEXT,
+    first_seen TEXT,
+    last_seen TEXT,
+    params TEXT,         -- JSON object
+    call_date TEXT       -- call_time_columns(first_seen)[1], for the report
+);
+"""
+
+# Rollups kept up to date by CallWriter, in the transaction that commits the calls; the report and the
+# 'query' subcommand read these instead of scanning call. name -> (key columns, SELECT that rebuilds it)
+UNDATED = ''  # rollup date of calls whose timestamp did not parse (NULL call_date would never hit ON CONFLICT)
+SUMMARY_TABLES = {
+    # calls per (username, date, endpoint); date is call.call_date
+    'call_daily_summary': (
+        ('username', 'date', 'endpoint'),
+        "SELECT username, IFNULL(call_date, ''), endpoint, COUNT(*) FROM call GROUP BY 1, 2, 3"),
+    # calls per (date, UTC hour, endpoint)
+    'call_hourly_summary': (
+        ('date', 'hour', 'endpoint'),
+        "SELECT call_date, call_epoch / 3600 % 24, endpoint, COUNT(*) FROM call WHERE call_epoch IS NOT NULL "
+        "GROUP BY 1, 2, 3"),
+    # calls per (date, ticker parameter, endpoint)
+    'ticker_daily_summary': (
+        ('date', 'ticker', 'endpoint'),
+        "SELECT IFNULL(c.call_date, ''), p.parameter_value, c.endpoint, COUNT(*) FROM call_parameters p "
+        "JOIN call c ON c.ID = p.call_id WHERE p.parameter_name = 'ticker' GROUP BY 1, 2, 3"),
+}
+
+def create_summary_sql(name):
+    keys = SUMMARY_TABLES[name][0]
+    return (f"CREATE TABLE IF NOT EXISTS {name} ({', '.join(keys)}, number_of_calls INTEGER, "
+            f"PRIMARY KEY ({', '.join(keys)}));")
+
+def upsert_summary_sql(name):
+    keys = SUMMARY_TABLES[name][0]
+    return (f"INSERT INTO {name} ({', '.join(keys)}, number_of_calls) VALUES ({', '.join('?' * (len(keys) + 1))}) "
+            f"ON CONFLICT ({', '.join(keys)}) DO UPDATE SET number_of_calls = number_of_calls + excluded.number_of_calls;")
+
+# client-side id allocation: next free id per table (see reserve_ids)
+CREATE_ID_ALLOCATOR_TABLE = """
+CREATE TABLE IF NOT EXISTS id_allocator (
+    name TEXT PRIMARY KEY,  -- table the ids are for
+    next_id INTEGER
+);
+"""
+
+# secondary indexes, by name (--bulk-load drops them during the load and rebuilds them at the end)
+CREATE_INDEXES = {
+    'idx_call_user_date_endpoint': "CREATE INDEX IF NOT EXISTS idx_call_user_date_endpoint ON call(username, date_of_call, endpoint);",
+    'idx_call_epoch': "CREATE INDEX IF NOT EXISTS idx_call_epoch ON call(call_epoch);",
+    # covering index: per-day / per-endpoint counts are index-only scans
+    'idx_call_date_endpoint_user': "CREATE INDEX IF NOT EXISTS idx_call_date_endpoint_user ON call(call_date, endpoint, username);",
+}
+# the same indexes for --normalized-schema
+CREATE_NORMALIZED_INDEXES = {
+    'idx_call_user_date_endpoint': "CREATE INDEX IF NOT EXISTS idx_call_user_date_endpoint ON call_fact(user_id, date_of_call, endpoint_id);",
+    'idx_call_epoch': "CREATE INDEX IF NOT EXISTS idx_call_epoch ON call_fact(call_epoch);",
+    'idx_call_date_endpoint_user': "CREATE INDEX IF NOT EXISTS idx_call_date_endpoint_user ON call_fact(call_date, endpoint_id, user_id);",
+}
+
+INSERT_CALL = ("INSERT INTO call (ID, username, date_of_call, ip_address, endpoint, call_epoch, call_date) "
+               "VALUES (?, ?, ?, ?, ?, ?, ?);")
+INSERT_CALL_PARAM = "INSERT INTO call_parameters (call_id, parameter_name, parameter_value) VALUES (?, ?, ?);"
+INSERT_CALL_FACT = ("INSERT INTO call_fact (ID, user_id, date_of_call, ip_address, endpoint_id, call_epoch, call_date) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?);")
+INSERT_CALL_PARAM_FACT = "INSERT INTO call_parameter_fact (call_id, parameter_name_id, parameter_value) VALUES (?, ?, ?);"
+
+# --bulk-load connection settings
+BULK_LOAD_PRAGMAS = [
+    "PRAGMA journal_mode=WAL;",
+    "PRAGMA synchronous=OFF;",
+    "PRAGMA cache_size=-262144;",      # 256 MiB page cache
+    "PRAGMA mmap_size=1073741824;",    # 1 GiB
+    "PRAGMA temp_store=MEMORY;",
 ]
+BULK_TRANSACTION_ROWS = 1000000  # --bulk-load commits after this many calls instead of every batch
 
-def init_db(conn):
+# --dedup: fingerprints of the stored calls; the primary key is the unique index that decides what is a duplicate
+CREATE_FINGERPRINT_TABLE = """
+CREATE TABLE IF NOT EXISTS call_fingerprint (
+    fingerprint INTEGER PRIMARY KEY  -- call_fingerprint() of a stored call
+);
+"""
+INSERT_FINGERPRINT = "INSERT OR IGNORE INTO call_fingerprint (fingerprint) VALUES (?);"
+FINGERPRINTED_THROUGH = 'call_fingerprint'  # id_allocator row: calls with a lower ID have been fingerprinted
+# the Bloom filter a --dedup run ended with, so the next one only adds the calls stored since
+CREATE_BLOOM_TABLE = """
+CREATE TABLE IF NOT EXISTS call_fingerprint_bloom (
+    through INTEGER,  -- a FINGERPRINTED_THROUGH value: the fingerprints of all calls with a lower ID are in it
+    filter BLOB       -- ScalableBloomFilter.to_bytes()
+);
+"""
+BLOOM_CAPACITY = 1 << 20   # fingerprints the first Bloom filter is sized for (each further one doubles)
+BLOOM_ERROR_RATE = 0.001   # false positive rate of the whole scalable Bloom filter
+SQL_IN_CHUNK = 500         # values per 'IN (...)' lookup
+
+def init_db(conn, create_indexes=True, normalized=False, partition=None):
+    """
+    Create the schema. normalized picks the --normalized-schema layout for a new DB, partition ('day' or
+    'month') the --partition one; an existing DB keeps the layout it was created with. Returns whether the
+    DB uses the normalized layout.
+    """
     cur = conn.cursor()
-    cur.execute(CREATE_CALL_TABLE)
-    cur.execute(CREATE_CALL_PARAMS_TABLE)
-    for s in CREATE_INDEXES:
-        cur.execute(s)
+    existing = cur.execute("SELECT type FROM sqlite_master WHERE name = 'call';").fetchone()
+    if existing is not None:
+        partition = partition_granularity(cur)
+        normalized = existing[0] == 'view' and partition is None
+    elif normalized and partition:
+        raise ValueError("--partition is only available for the plain (not --normalized-schema) layout")
+    if normalized:
+        for s in CREATE_NORMALIZED_TABLES:
+            cur.execute(s)
+    elif partition:
+        if existing is None:
+            for s in CREATE_PARTITIONING_TABLES:
+                cur.execute(s)
+            cur.execute("INSERT INTO call_partitioning (granularity) VALUES (?);", (partition,))
+            CallPartitions(cur).add(UNDATED_PARTITION, create_indexes)
+    else:
+        cur.execute(CREATE_CALL_TABLE)
+        cur.execute(CREATE_CALL_PARAMS_TABLE)
+    cur.execute(CREATE_CHECKPOINT_TABLE)
+    if 'head_hash' not in {row[1] for row in cur.execute("PRAGMA table_info(ingest_checkpoint);")}:
+        # DB from before head_hash: its checkpoints just are not matched by content
+        cur.execute("ALTER TABLE ingest_checkpoint ADD COLUMN head_hash TEXT;")
+        cur.execute("ALTER TABLE ingest_checkpoint ADD COLUMN head_size INTEGER;")
+    cur.execute(CREATE_OPEN_CALL_TABLE)
+    cur.execute(CREATE_ID_ALLOCATOR_TABLE)
+    cur.execute("INSERT OR IGNORE INTO id_allocator (name, next_id) VALUES (?, 1);", (call_table(normalized),))
+    if partition:
+        cur.execute("INSERT OR IGNORE INTO id_allocator (name, next_id) VALUES ('call_parameters', 1);")
+    rebuild = add_call_time_columns(cur)
+    for name, (keys, select) in SUMMARY_TABLES.items():
+        exists = cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?;", (name,)).fetchone()
+        cur.execute(create_summary_sql(name))
+        if rebuild or not exists:
+            # DB from before this rollup (or before call_date) existed: build it from the calls already stored
+            cur.execute(f"DELETE FROM {name};")
+            cur.execute(f"INSERT INTO {name} ({', '.join(keys)}, number_of_calls) {select};")
+    if create_indexes and not partition:  # partitions get theirs with their tables
+        for s in call_indexes(normalized).values():
+            cur.execute(s)
     conn.commit()
+    return normalized
+
+def call_table(normalized):
+    # the table call rows are inserted into (and call ids reserved for)
+    return 'call_fact' if normalized else 'call'
+
+def call_indexes(normalized):
+    return CREATE_NORMALIZED_INDEXES if normalized else CREATE_INDEXES
+
+def add_call_time_columns(cur):
+    # DB from before call_epoch / call_date: add them and fill them in. Returns True if it did.
+    if 'call_date' in {row[1] for row in cur.execute("PRAGMA table_info(call);")}:
+        return False
+    cur.execute("ALTER TABLE call ADD COLUMN call_epoch INTEGER;")
+    cur.execute("ALTER TABLE call ADD COLUMN call_date TEXT;")
+    if 'call_date' not in {row[1] for row in cur.execute("PRAGMA table_info(open_call);")}:
+        cur.execute("ALTER TABLE open_call ADD COLUMN call_date TEXT;")
+    cur.execute("DROP INDEX IF EXISTS idx_call_date;")  # on the raw text; replaced by idx_call_epoch
+    update = cur.connection.cursor()
+    rows = cur.execute("SELECT ID, date_of_call FROM call;")
+    while True:
+        batch = rows.fetchmany(DB_BATCH_SIZE)
+        if not batch:
+            break
+        update.executemany("UPDATE call SET call_epoch = ?, call_date = ? WHERE ID = ?;",
+                           [call_time_columns(text or '') + (call_id,) for call_id, text in batch])
+    update.executemany("UPDATE open_call SET call_date = ? WHERE rowid = ?;",
+                       [(call_time_columns(text or '')[1], rowid)
+                        for rowid, text in cur.execute("SELECT rowid, first_seen FROM open_call;").fetchall()])
+    return True
+
+def reserve_ids(cur, table, n, unreserved_rows=True):
+    """
+    Reserve n consecutive ids for table and return the first one.
+    The UPDATE takes the database write lock, so the range belongs to the caller's transaction: concurrent
+    writers (other connections or processes) get disjoint ranges, and a rolled back transaction gives its
+    range back. Rows inserted without a reservation are skipped over (MAX(ID) on the rowid is O(log n)).
+    unreserved_rows=False: there are none (table is a --partition view, whose MAX(ID) would scan every partition).
+    """
+    if unreserved_rows:
+        cur.execute(f"UPDATE id_allocator SET next_id = MAX(next_id, (SELECT IFNULL(MAX(ID), 0) + 1 FROM {table})) + ? "
+                    "WHERE name = ?;", (n, table))
+    else:
+        cur.execute("UPDATE id_allocator SET next_id = next_id + ? WHERE name = ?;", (n, table))
+    return cur.execute("SELECT next_id FROM id_allocator WHERE name = ?;", (table,)).fetchone()[0] - n
+
+def partition_granularity(cur):
+    # 'day' / 'month' for a --partition DB, else None
+    if cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'call_partitioning';").fetchone() is None:
+        return None
+    return cur.execute("SELECT granularity FROM call_partitioning;").fetchone()[0]
+
+def connect_read_only(db_path):
+    # open an existing DB without creating it or taking the write lock (sqlite3.OperationalError if missing)
+    return sqlite3.connect(f"file:{urllib.parse.quote(os.path.abspath(db_path))}?mode=ro", uri=True)
+
+def retention_horizon():
+    # latest call_date --retain-days counts from (a mistyped far-future timestamp must not expire everything)
+    return (datetime.utcnow().date() + timedelta(days=RETENTION_FUTURE_DAYS)).isoformat()
+
+def partition_bounds(call_date, granularity):
+    # (first_date, end_date) of the partition holding call_date
+    first = date.fromisoformat(call_date)
+    if granularity == 'day':
+        return first.isoformat(), (first + timedelta(days=1)).isoformat()
+    first = first.replace(day=1)
+    return first.isoformat(), (first + timedelta(days=32)).replace(day=1).isoformat()
+
+class CallPartitions:
+    """
+    --partition: the tables behind call / call_parameters in a partitioned DB, one pair per UTC day or month
+    of call_date (call_p20240301 and call_parameters_p20240301, or _p202403 by month) plus call_undated /
+    call_parameters_undated for calls without a parsed timestamp. call and call_parameters are UNION ALL views
+    over them, recreated whenever a partition is added or dropped, so readers see the usual two tables; the
+    partitions are listed in call_partition, and each gets the CREATE_INDEXES of the call table.
+    drop_expired removes whole partitions: DROP TABLE frees their pages in one step (for reuse by new
+    partitions) where a DELETE of old rows would visit and rewrite every one of them.
+    """
+    def __init__(self, cur):
+        self.cur = cur
+        self.granularity = partition_granularity(cur)
+        # suffix -> (first_date, end_date)
+        self.ranges = {suffix: (first, end) for suffix, first, end in
+                       cur.execute("SELECT suffix, first_date, end_date FROM call_partition;").fetchall()}
+        self.newest = None  # newest call_date written, up to retention_horizon()
+        horizon = retention_horizon()
+        for suffix in sorted((suffix for suffix, (first, _) in self.ranges.items() if first is not None and first <= horizon),
+                             reverse=True):
+            self.newest = cur.execute(f"SELECT MAX(call_date) FROM call_{suffix} WHERE call_date <= ?;",
+                                      (horizon,)).fetchone()[0]
+            if self.newest is not None:
+                break
+
+    def suffix(self, call_date):
+        if call_date is None:
+            return UNDATED_PARTITION
+        return 'p' + call_date[:PARTITION_GRANULARITIES[self.granularity]].replace('-', '')
+
+    def indexes(self, suffix=None):
+        # index name -> CREATE INDEX, for one partition or all of them
+        suffixes = [suffix] if suffix is not None else sorted(self.ranges)
+        return {f"{name}_{s}": sql.replace(name, f"{name}_{s}").replace(" ON call(", f" ON call_{s}(")
+                for s in suffixes for name, sql in CREATE_INDEXES.items()}
+
+    def add(self, suffix, create_indexes=True, call_date=None):
+        # create the partition for call_date (the undated one if None) unless it exists
+        if suffix in self.ranges:
+            return
+        first, end = partition_bounds(call_date, self.granularity) if call_date is not None else (None, None)
+        for s in CREATE_PARTITION_TABLES:
+            self.cur.execute(s.format(suffix=suffix))
+        if create_indexes:
+            for s in self.indexes(suffix).values():
+                self.cur.execute(s)
+        self.cur.execute("INSERT INTO call_partition (suffix, first_date, end_date) VALUES (?, ?, ?);",
+                         (suffix, first, end))
+        self.ranges[suffix] = (first, end)
+        self.create_views()
+
+    def create_views(self):
+        for view, table, columns in (
+                ('call', 'call_', 'ID, username, date_of_call, ip_address, endpoint, call_epoch, call_date'),
+                ('call_parameters', 'call_parameters_', 'id, call_id, parameter_name, parameter_value')):
+            selects = [f"SELECT {columns} FROM {table}{suffix}" for suffix in sorted(self.ranges)]
+            groups = [" UNION ALL ".join(selects[i:i + VIEW_UNION_TERMS])
+                      for i in range(0, len(selects), VIEW_UNION_TERMS)]
+            body = groups[0] if len(groups) == 1 else " UNION ALL ".join(f"SELECT * FROM ({g})" for g in groups)
+            self.cur.execute(f"DROP VIEW IF EXISTS {view};")
+            self.cur.execute(f"CREATE VIEW {view} AS {body};")
+
+    def drop_expired(self, retain_days):
+        """
+        Drop the partitions that end more than retain_days before the newest call written (event time, like
+        the merge watermark, so replaying old logs keeps what a live run would), and their dates' rollup rows.
+        Calls dated after retention_horizon() do not count as the newest. Returns the dropped suffixes.
+        """
+        if self.newest is None:
+            return []
+        cutoff = (date.fromisoformat(self.newest) - timedelta(days=retain_days)).isoformat()
+        expired = sorted(suffix for suffix, (first, end) in self.ranges.items() if end is not None and end <= cutoff)
+        for suffix in expired:
+            first, end = self.ranges.pop(suffix)
+            self.cur.execute(f"DROP TABLE call_{suffix};")
+            self.cur.execute(f"DROP TABLE call_parameters_{suffix};")
+            self.cur.execute("DELETE FROM call_partition WHERE suffix = ?;", (suffix,))
+            for name in SUMMARY_TABLES:
+                self.cur.execute(f"DELETE FROM {name} WHERE date >= ? AND date < ?;", (first, end))
+        if expired:
+            self.create_views()
+        return expired
+
+class DimensionTable:
+    """
+    In-process text -> id cache for one --normalized-schema dimension table. The whole table is loaded up
+    front; a value not seen yet is inserted (INSERT OR IGNORE, so other writers' rows are reused) in the
+    caller's transaction. Known values cost one dict lookup.
+    """
+    def __init__(self, cur, table, column):
+        self.cur = cur
+        self.insert_sql = f"INSERT OR IGNORE INTO {table} ({column}) VALUES (?);"
+        self.select_sql = f"SELECT id FROM {table} WHERE {column} = ?;"
+        self.ids = {value: i for i, value in cur.execute(f"SELECT id, {column} FROM {table};")}
+
+    def id(self, value):
+        i = self.ids.get(value)
+        if i is None:
+            self.cur.execute(self.insert_sql, (value,))
+            i = self.ids[value] = self.cur.execute(self.select_sql, (value,)).fetchone()[0]
+        return i
+
+def call_fingerprint(username, ip, endpoint, call_epoch, date_of_call, params):
+    """
+    64-bit fingerprint of a normalized call for --dedup: user, ip, endpoint, time (call_epoch, so the same
+    second written in two timestamp layouts matches; the text if it did not parse) and the parameters in any
+    order. Signed, to fit an SQLite INTEGER.
+    """
+    when = date_of_call or '' if call_epoch is None else str(call_epoch)
+    text = '\x1f'.join([username or '', ip or '', endpoint or '', when]
+                        + sorted(f"{name}={value}" for name, value in params))
+    digest = hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+class ScalableBloomFilter:
+    """
+    Bloom filter over 64-bit ints that grows with its contents (Almeida et al., "Scalable Bloom Filters"):
+    when the newest filter holds its capacity another one, twice as large and with half the false positive
+    rate, is added, so the rate over all of them stays below error_rate however many items arrive.
+    The bit positions come from double hashing the two 32-bit halves of the item, which is already a hash.
+    """
+    def __init__(self, capacity=BLOOM_CAPACITY, error_rate=BLOOM_ERROR_RATE):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.filters = []  # [bits, number of bits, hashes, capacity, items added]
+        self._add_filter()
+
+    def _add_filter(self):
+        i = len(self.filters)
+        capacity = self.capacity << i
+        error = self.error_rate / 2 ** (i + 1)
+        nbits = math.ceil(capacity * -math.log(error) / math.log(2) ** 2)
+        k = max(1, round(nbits / capacity * math.log(2)))
+        self.filters.append([bytearray((nbits + 7) // 8), nbits, k, capacity, 0])
+
+    @staticmethod
+    def _positions(item, nbits, k):
+        item &= 0xFFFFFFFFFFFFFFFF
+        h1, h2 = item & 0xFFFFFFFF, item >> 32 | 1
+        return [(h1 + i * h2) % nbits for i in range(k)]
+
+    def __contains__(self, item):
+        for bits, nbits, k, _, _ in self.filters:
+            if all(bits[p >> 3] & (1 << (p & 7)) for p in self._positions(item, nbits, k)):
+                return True
+        return False
+
+    def add(self, item):
+        f = self.filters[-1]
+        if f[4] >= f[3]:
+            self._add_filter()
+            f = self.filters[-1]
+        bits = f[0]
+        for p in self._positions(item, f[1], f[2]):
+            bits[p >> 3] |= 1 << (p & 7)
+        f[4] += 1
+
+    def to_bytes(self):
+        # capacity and error rate, then each filter's header and bits
+        parts = [struct.pack('<Qd', self.capacity, self.error_rate)]
+        for bits, nbits, k, capacity, count in self.filters:
+            parts.append(struct.pack('<4Q', nbits, k, capacity, count))
+            parts.append(bytes(bits))
+        return b''.join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        bloom = cls.__new__(cls)
+        bloom.capacity, bloom.error_rate = struct.unpack_from('<Qd', data)
+        bloom.filters = []
+        pos = struct.calcsize('<Qd')
+        while pos < len(data):
+            nbits, k, capacity, count = struct.unpack_from('<4Q', data, pos)
+            pos += struct.calcsize('<4Q')
+            bloom.filters.append([bytearray(data[pos:pos + (nbits + 7) // 8]), nbits, k, capacity, count])
+            pos += (nbits + 7) // 8
+        return bloom
+
+class CallDeduplicator:
+    """
+    --dedup: drops calls identical (call_fingerprint) to a stored call or to one earlier in the batch.
+    A ScalableBloomFilter of every stored fingerprint answers 'certainly new' for almost all new calls in
+    memory; only its positives are looked up in call_fingerprint. The fingerprints of the kept calls are
+    inserted in the caller's transaction, and the table's primary key is the final word: if another writer
+    stored some of them since the lookup (insert count short), the batch is checked again under the write lock.
+    On start, calls written since the last --dedup run (or ever, on a DB new to it) are fingerprinted first.
+    The Bloom filter is saved by save_bloom() (CallWriter.finish) and loaded by the next run, which only adds
+    the calls stored since; without a saved one it is built from the whole call_fingerprint table.
+    Fingerprints are 64 bits: distinct calls collide with a probability of about n^2 / 2^65.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.cur = conn.cursor()
+        self.cur.execute(CREATE_FINGERPRINT_TABLE)
+        self.cur.execute(CREATE_BLOOM_TABLE)
+        self.cur.execute("INSERT OR IGNORE INTO id_allocator (name, next_id) VALUES (?, 1);", (FINGERPRINTED_THROUGH,))
+        self.bloom_through = None
+        self._catch_up()
+        conn.commit()
+        # bloom_through: the filter holds the fingerprints of every call with a lower ID (a superset is harmless)
+        self.bloom_through = self.cur.execute("SELECT next_id FROM id_allocator WHERE name = ?;",
+                                              (FINGERPRINTED_THROUGH,)).fetchone()[0]
+        saved = self.cur.execute("SELECT through, filter FROM call_fingerprint_bloom;").fetchone()
+        if saved is not None:
+            self.bloom = ScalableBloomFilter.from_bytes(saved[1])
+            for _, fingerprint in self._call_fingerprints(saved[0]):
+                self.bloom.add(fingerprint)
+        else:
+            count = self.cur.execute("SELECT COUNT(*) FROM call_fingerprint;").fetchone()[0]
+            self.bloom = ScalableBloomFilter(max(BLOOM_CAPACITY, 2 * count))
+            for (fingerprint,) in self.cur.execute("SELECT fingerprint FROM call_fingerprint;"):
+                self.bloom.add(fingerprint)
+
+    def _call_fingerprints(self, start):
+        # (ID, call_fingerprint) of the stored calls with ID >= start, in ID order
+        calls = self.conn.execute("SELECT ID, username, date_of_call, ip_address, endpoint, call_epoch FROM call "
+                                  "WHERE ID >= ? ORDER BY ID;", (start,))
+        params = self.conn.execute("SELECT call_id, parameter_name, parameter_value FROM call_parameters "
+                                   "WHERE call_id >= ? ORDER BY call_id, id;", (start,))
+        param = next(params, None)
+        for call_id, username, date_of_call, ip, endpoint, call_epoch in calls:
+            call_params = []
+            while param is not None and param[0] <= call_id:
+                if param[0] == call_id:
+                    call_params.append(param[1:])
+                param = next(params, None)
+            yield call_id, call_fingerprint(username, ip, endpoint, call_epoch, date_of_call, call_params)
+
+    def _catch_up(self):
+        # fingerprint the calls not fingerprinted yet (written without --dedup); duplicates among them stay
+        start = self.cur.execute("SELECT next_id FROM id_allocator WHERE name = ?;", (FINGERPRINTED_THROUGH,)).fetchone()[0]
+        rows, last_id = [], None
+        for call_id, fingerprint in self._call_fingerprints(start):
+            rows.append((fingerprint,))
+            last_id = call_id
+            if len(rows) >= DB_BATCH_SIZE:
+                self.cur.executemany(INSERT_FINGERPRINT, rows)
+                rows = []
+        self.cur.executemany(INSERT_FINGERPRINT, rows)
+        if last_id is not None:
+            self.mark(last_id + 1)
+
+    def mark(self, next_call_id, first_call_id=None):
+        # calls below next_call_id are fingerprinted; first_call_id: where this writer's batch, already added to
+        # the Bloom filter, starts (the filter only covers a range no other writer has written into)
+        self.cur.execute("UPDATE id_allocator SET next_id = MAX(next_id, ?) WHERE name = ?;",
+                         (next_call_id, FINGERPRINTED_THROUGH))
+        if first_call_id is not None and first_call_id == self.bloom_through:
+            self.bloom_through = next_call_id
+
+    def save_bloom(self):
+        # store the Bloom filter in the caller's transaction, for the next run
+        self.cur.execute("DELETE FROM call_fingerprint_bloom;")
+        self.cur.execute("INSERT INTO call_fingerprint_bloom (through, filter) VALUES (?, ?);",
+                         (self.bloom_through, self.bloom.to_bytes()))
+
+    def stored(self, fingerprints):
+        # the ones already in call_fingerprint
+        found = set()
+        for i in range(0, len(fingerprints), SQL_IN_CHUNK):
+            chunk = fingerprints[i:i + SQL_IN_CHUNK]
+            found.update(row[0] for row in self.cur.execute(
+                f"SELECT fingerprint FROM call_fingerprint WHERE fingerprint IN ({', '.join('?' * len(chunk))});", chunk))
+        return found
+
+    def drop_duplicates(self, calls, params):
+        """
+        (calls, params) without the duplicate calls, in CallWriter.write's batch format (parameter indexes are
+        renumbered). Opens the write transaction that CallWriter.write then continues and commits.
+        """
+        call_params = [[] for _ in calls]
+        for idx, name, value in params:
+            call_params[idx].append((name, value))
+        fingerprints = [call_fingerprint(call[0], call[2], call[3], call[4], call[1], p)
+                        for call, p in zip(calls, call_params)]
+        keep, seen, maybe = [], set(), []
+        for i, fingerprint in enumerate(fingerprints):
+            if fingerprint in seen:
+                continue
+            seen.add(fingerprint)
+            if fingerprint in self.bloom:
+                maybe.append(fingerprint)
+            keep.append(i)
+        if maybe:
+            stored = self.stored(maybe)
+            keep = [i for i in keep if fingerprints[i] not in stored]
+        if keep:
+            if not self.conn.in_transaction:
+                self.cur.execute("BEGIN;")  # so releasing the savepoint does not commit
+            self.cur.execute("SAVEPOINT dedup;")
+            self.cur.executemany(INSERT_FINGERPRINT, [(fingerprints[i],) for i in keep])
+            if self.cur.rowcount != len(keep):
+                # another writer stored some of them after the lookup: look again, now holding the write lock
+                self.cur.execute("ROLLBACK TO dedup;")
+                stored = self.stored([fingerprints[i] for i in keep])
+                keep = [i for i in keep if fingerprints[i] not in stored]
+                self.cur.executemany(INSERT_FINGERPRINT, [(fingerprints[i],) for i in keep])
+            self.cur.execute("RELEASE dedup;")
+        for i in keep:
+            self.bloom.add(fingerprints[i])
+        if len(keep) == len(calls):
+            return calls, params
+        new_index = {old: new for new, old in enumerate(keep)}
+        return ([calls[i] for i in keep],
+                [(new_index[idx], name, value) for idx, name, value in params if idx in new_index])
+
+class CallWriter:
+    """
+    Writes call / call_parameters batches. Parameters refer to their call by position in the batch:
+    (index into calls, name, value). Call ids are reserved up front (reserve_ids), so a batch's calls and
+    parameters go out in the same transaction and several writers can share the database.
+    Written calls are also counted for the SUMMARY_TABLES rollups; the counts are added to those tables in the
+    transaction that commits the calls, so the report and queries never have to scan the call table.
+
+    Default: each batch is committed as it is written.
+    incremental: write() never commits; commit() / finish() do, after the caller has added the --incremental
+    state (open calls, checkpoints) for the written calls to the same transaction.
+    bulk_load: the connection is tuned for ingestion (BULK_LOAD_PRAGMAS), the secondary indexes are dropped
+    and only rebuilt by finish() (followed by ANALYZE), and a transaction spans BULK_TRANSACTION_ROWS calls.
+    normalized: the DB uses the --normalized-schema layout (what init_db returned); username, endpoint and
+    parameter name are written as ids from DimensionTable caches.
+    dedup: self.dedup is a CallDeduplicator; batches should go through its drop_duplicates before write().
+    A --partition DB (self.partitions) gets every call and its parameters in the partition of its call_date;
+    retain_days: each commit also drops the partitions older than that (CallPartitions.drop_expired).
+    """
+    def __init__(self, conn, bulk_load=False, normalized=False, dedup=False, retain_days=None, incremental=False):
+        self.conn = conn
+        self.cur = conn.cursor()
+        self.bulk_load = bulk_load
+        self.incremental = incremental
+        self.normalized = normalized
+        self.table = call_table(normalized)
+        self.indexes = call_indexes(normalized)
+        self.partitions = CallPartitions(self.cur) if partition_granularity(self.cur) else None
+        if retain_days is not None and self.partitions is None:
+            raise ValueError("--retain-days needs a DB created with --partition")
+        if retain_days is not None and retain_days < 0:
+            raise ValueError("--retain-days cannot be negative")
+        self.retain_days = retain_days
+        self.uncommitted = 0
+        # rollup name -> {key: calls written since the last commit}
+        self.summary_counts = {name: Counter() for name in SUMMARY_TABLES}
+        self.summary_upserts = {name: upsert_summary_sql(name) for name in SUMMARY_TABLES}
+        if normalized:
+            self.users = DimensionTable(self.cur, 'user_dim', 'username')
+            self.endpoints = DimensionTable(self.cur, 'endpoint_dim', 'endpoint')
+            self.param_names = DimensionTable(self.cur, 'param_name_dim', 'parameter_name')
+        self.dedup = CallDeduplicator(conn) if dedup else None
+        if bulk_load:
+            for pragma in BULK_LOAD_PRAGMAS:
+                self.cur.execute(pragma)
+            for name in self.all_indexes():
+                self.cur.execute(f"DROP INDEX IF EXISTS {name};")
+            conn.commit()
+
+    def all_indexes(self):
+        return self.partitions.indexes() if self.partitions is not None else self.indexes
+
+    def write(self, calls, params):
+        if not calls:
+            return
+        first_id = reserve_ids(self.cur, self.table, len(calls), unreserved_rows=self.partitions is None)
+        if self.dedup is not None:
+            self.dedup.mark(first_id + len(calls), first_id)
+        if self.partitions is not None:
+            self.write_partitioned(first_id, calls, params)
+        elif self.normalized:
+            user_id, endpoint_id, param_name_id = self.users.id, self.endpoints.id, self.param_names.id
+            self.cur.executemany(INSERT_CALL_FACT, [
+                (first_id + idx, user_id(username), date_of_call, ip, endpoint_id(endpoint), call_epoch, call_date)
+                for idx, (username, date_of_call, ip, endpoint, call_epoch, call_date) in enumerate(calls)])
+            if params:
+                self.cur.executemany(INSERT_CALL_PARAM_FACT,
+                                     [(first_id + idx, param_name_id(name), val) for idx, name, val in params])
+        else:
+            self.cur.executemany(INSERT_CALL, [(first_id + idx,) + call for idx, call in enumerate(calls)])
+            if params:
+                self.cur.executemany(INSERT_CALL_PARAM, [(first_id + idx, name, val) for idx, name, val in params])
+        counts = self.summary_counts
+        # calls are (username, date_of_call, ip, endpoint, call_epoch, call_date)
+        counts['call_daily_summary'].update((call[0], call[5] or UNDATED, call[3]) for call in calls)
+        counts['call_hourly_summary'].update((call[5], call[4] // 3600 % 24, call[3]) for call in calls
+                                             if call[4] is not None)
+        counts['ticker_daily_summary'].update((calls[idx][5] or UNDATED, val, calls[idx][3]) for idx, name, val in params
+                                              if name == 'ticker')
+        self.uncommitted += len(calls)
+        if not self.incremental and (not self.bulk_load or self.uncommitted >= BULK_TRANSACTION_ROWS):
+            self.commit()
+        return first_id
+
+    def write_partitioned(self, first_id, calls, params):
+        partitions = self.partitions
+        suffixes = [partitions.suffix(call[5]) for call in calls]
+        call_rows, param_rows = defaultdict(list), defaultdict(list)
+        for idx, call in enumerate(calls):
+            call_rows[suffixes[idx]].append((first_id + idx,) + call)
+        if params:
+            first_param_id = reserve_ids(self.cur, 'call_parameters', len(params), unreserved_rows=False)
+            for n, (idx, name, val) in enumerate(params):
+                param_rows[suffixes[idx]].append((first_param_id + n, first_id + idx, name, val))
+        for suffix, rows in call_rows.items():
+            partitions.add(suffix, not self.bulk_load, rows[0][6])
+            self.cur.executemany(f"INSERT INTO call_{suffix} (ID, username, date_of_call, ip_address, endpoint, "
+                                 "call_epoch, call_date) VALUES (?, ?, ?, ?, ?, ?, ?);", rows)
+            if param_rows[suffix]:
+                self.cur.executemany(f"INSERT INTO call_parameters_{suffix} (id, call_id, parameter_name, "
+                                     "parameter_value) VALUES (?, ?, ?, ?);", param_rows[suffix])
+        horizon = retention_horizon()
+        newest = max((call[5] for call in calls if call[5] is not None and call[5] <= horizon), default=None)
+        if newest is not None and (partitions.newest is None or newest > partitions.newest):
+            partitions.newest = newest
+
+    def commit(self):
+        for name, counts in self.summary_counts.items():
+            if counts:
+                self.cur.executemany(self.summary_upserts[name], [key + (n,) for key, n in counts.items()])
+                counts.clear()
+        if self.retain_days is not None:
+            self.partitions.drop_expired(self.retain_days)
+        self.conn.commit()
+        self.uncommitted = 0
+
+    def finish(self):
+        if self.dedup is not None:
+            self.dedup.save_bloom()
+        self.commit()
+        if self.bulk_load:
+            self.cur.execute("PRAGMA synchronous=FULL;")
+            for s in self.all_indexes().values():
+                self.cur.execute(s)
+            self.cur.execute("ANALYZE;")
+            self.conn.commit()
+
+WRITER_QUEUE_BATCHES = 8  # --writer-thread: DB jobs that may wait for the writer before the producer blocks
+
+class BackgroundWriter:
+    """
+    Runs DB work (call batches, commits) on a dedicated thread, fed through a bounded queue, so parsing and
+    merging continue while SQLite writes. submit() blocks once WRITER_QUEUE_BATCHES jobs are waiting
+    (backpressure when the writer falls behind). Jobs run in submission order.
+    The connection they use must be opened with check_same_thread=False and not touched by other threads
+    until close() returns. An exception on the writer thread is raised again by the next submit() or close().
+    """
+    def __init__(self, depth=WRITER_QUEUE_BATCHES):
+        self.jobs = queue.Queue(maxsize=depth)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            if self.error is None:  # after a failure, keep draining so submit() never blocks forever
+                try:
+                    job[0](*job[1:])
+                except Exception as exc:  # handed to the submitting thread
+                    self.error = exc
+
+    def submit(self, fn, *args):
+        if self.error is not None:
+            raise self.error
+        self.jobs.put((fn,) + args)
+
+    def close(self):
+        # wait for the queued jobs to finish
+        self.jobs.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+def last_newline_end(path, start, end):
+    # offset just past the last b'\n' in path[start:end], or start if there is none
+    with open(path, 'rb') as fh:
+        pos = end
+        while pos > start:
+            block_start = max(start, pos - 64 * 1024)
+            fh.seek(block_start)
+            i = fh.read(pos - block_start).rfind(b'\n')
+            if i >= 0:
+                return block_start + i + 1
+            pos = block_start
+    return start
+
+def plan_incremental_ranges(conn, files):
+    """
+    Work out what is new in each input since the last --incremental run.
+    Returns (ranges, checkpoints): (path, start, end) ranges for iter_record_chunks, and the
+    ingest_checkpoint rows to store once those ranges are in the DB.
+
+     - A file is matched to its checkpoint by path, or by inode when it was renamed by rotation
+       (app.log -> app.log.1); a different inode at the same path is a new file.
+     - A file smaller than its checkpoint offset was truncated and is read from the start.
+     - Plain files are read up to their last newline; a partly written last line waits for the next run.
+     - Compressed files are immutable rotations: skipped if already seen at the same size, else read whole.
+       An unseen one whose decompressed start matches a plain file's checkpointed head (app.log read up to
+       some offset, then rotated and compressed to app.log.1.gz) is read from that offset on.
+    """
+    by_path = {}
+    by_inode = {}
+    by_head = []  # plain files' checkpoints, for compressed rotations of them
+    for row in conn.execute("SELECT path, inode, size, mtime, offset, head_hash, head_size FROM ingest_checkpoint;"):
+        by_path[row[0]] = row
+        by_inode[row[1]] = row
+        if row[5] is not None:
+            by_head.append(row)
+    ranges = []
+    checkpoints = []
+    for path in files:
+        st = os.stat(path)
+        prev = by_path.get(path)
+        if prev is None or prev[1] != st.st_ino:
+            prev = by_inode.get(st.st_ino)
+        start = 0
+        if prev is not None and prev[4] <= st.st_size:
+            start = prev[4]
+        compression = detect_compression(path)
+        if compression is not None:
+            if prev is None and by_head:
+                with open_decompressed(path, compression) as fh:
+                    head = read_head(fh)
+                for row in by_head:
+                    if row[6] <= len(head) and head_hash(head[:row[6]]) == row[5]:
+                        ranges.append((path, row[4], None))
+                        break
+                else:
+                    ranges.append((path, 0, None))
+            elif prev is None or not prev[4] == prev[2] == st.st_size:
+                ranges.append((path, 0, None))
+            checkpoints.append((path, st.st_ino, st.st_size, st.st_mtime, st.st_size, None, None))
+            continue
+        end = last_newline_end(path, start, st.st_size)
+        if end > start:
+            ranges.append((path, start, end))
+        with open(path, 'rb') as fh:
+            head = read_head(fh)
+        checkpoints.append((path, st.st_ino, st.st_size, st.st_mtime, end, head_hash(head) if head else None, len(head)))
+    return ranges, checkpoints
+
+def save_checkpoints(conn, checkpoints):
+    conn.executemany("INSERT OR REPLACE INTO ingest_checkpoint (path, inode, size, mtime, offset, head_hash, head_size) "
+                     "VALUES (?, ?, ?, ?, ?, ?, ?);", checkpoints)
+
+# ---------------------------
+# Columnar output
+# ---------------------------
+HIVE_NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'  # Hive's directory value for a NULL partition key
+
+def columnar_partition(call_date, endpoint):
+    # Hive-style partition directory: date=YYYY-MM-DD/endpoint=<percent-encoded endpoint>
+    return os.path.join(f"date={call_date or HIVE_NULL_PARTITION}", f"endpoint={urllib.parse.quote(endpoint, safe='')}")
+
+class ColumnarSink:
+    """
+    Writes the call batches that go to SQLite also as partitioned Parquet (or Arrow IPC) files:
+      <out_dir>/call/date=.../endpoint=.../part-<run>-<n>.parquet             call_id, username, date_of_call, ip_address,
+                                                                              call_epoch
+      <out_dir>/call_parameters/date=.../endpoint=.../part-<run>-<n>.parquet  call_id, parameter_name, parameter_value
+    date and endpoint live in the directory names (read back with partitioning='hive'). username, ip_address
+    and parameter_name are dictionary-encoded. Rows are buffered per partition and written out by size
+    (COLUMNAR_ROWS_PER_FILE, COLUMNAR_BUFFER_ROWS) and by close(); file names carry a per-run token, so later
+    runs (--incremental, --follow) add files instead of replacing them.
+    """
+    def __init__(self, out_dir, fmt='parquet'):
+        if pa is None:
+            raise RuntimeError("--columnar-dir needs the 'pyarrow' package")
+        self.out_dir = out_dir
+        self.fmt = fmt
+        self.run_token = f"{int(time.time())}-{os.getpid()}"
+        self.file_seq = itertools.count()
+        self.partitions = {}  # partition dir -> (calls, params) column lists
+        self.buffered = 0
+
+    def write(self, first_id, calls, params):
+        call_partition = []
+        for idx, (username, date_of_call, ip, endpoint, call_epoch, call_date) in enumerate(calls):
+            part = columnar_partition(call_date, endpoint)
+            call_partition.append(part)
+            cols = self.partitions.get(part)
+            if cols is None:
+                cols = self.partitions[part] = ({'call_id': [], 'username': [], 'date_of_call': [], 'ip_address': [],
+                                                 'call_epoch': []},
+                                                {'call_id': [], 'parameter_name': [], 'parameter_value': []})
+            call_cols = cols[0]
+            call_cols['call_id'].append(first_id + idx)
+            call_cols['username'].append(username)
+            call_cols['date_of_call'].append(date_of_call)
+            call_cols['ip_address'].append(ip)
+            call_cols['call_epoch'].append(call_epoch)
+        for idx, name, val in params:
+            param_cols = self.partitions[call_partition[idx]][1]
+            param_cols['call_id'].append(first_id + idx)
+            param_cols['parameter_name'].append(name)
+            param_cols['parameter_value'].append(val)
+        self.buffered += len(calls)
+        if self.buffered >= COLUMNAR_BUFFER_ROWS:
+            self.flush()
+        else:
+            for part in set(call_partition):
+                if len(self.partitions[part][0]['call_id']) >= COLUMNAR_ROWS_PER_FILE:
+                    self.flush_partition(part)
+
+    def flush_partition(self, part):
+        call_cols, param_cols = self.partitions.pop(part)
+        self.buffered -= len(call_cols['call_id'])
+        name = f"part-{self.run_token}-{next(self.file_seq):05d}"
+        self.write_table('call', part, name, call_cols, ('username', 'ip_address'))
+        if param_cols['call_id']:
+            self.write_table('call_parameters', part, name, param_cols, ('parameter_name',))
+
+    def write_table(self, table_name, part, name, columns, dictionary_columns):
+        table = pa.table({col: pa.array(values).dictionary_encode() if col in dictionary_columns else pa.array(values)
+                          for col, values in columns.items()})
+        directory = os.path.join(self.out_dir, table_name, part)
+        os.makedirs(directory, exist_ok=True)
+        if self.fmt == 'arrow':
+            with pa.OSFile(os.path.join(directory, name + '.arrow'), 'wb') as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+        else:
+            pq.write_table(table, os.path.join(directory, name + '.parquet'), compression='zstd')
+
+    def flush(self):
+        for part in list(self.partitions):
+            self.flush_partition(part)
+
+    def close(self):
+        self.flush()
 
 # ---------------------------
 # Processing logic
 # ---------------------------
+def intern_call_fields(endpoint, params, username, ip):
+    """
+    Intern the strings that repeat across millions of calls (endpoint, username, ip, parameter names), so the
+    merge buffer and the insert batches share one object per distinct value instead of one per line.
+    """
+    intern = sys.intern
+    return (intern(endpoint), {intern(k): v for k, v in params.items()}, intern(username), intern(ip))
+
 class CallBufferItem:
-    def __init__(self, username, ip, endpoint, timestamp_text):
+    # __slots__: no per-instance __dict__; there can be hundreds of thousands of open calls
+    __slots__ = ('username', 'ip', 'endpoint', 'params', 'first_seen', 'last_seen', 'last_dt', 'heap_seq')
+
+    def __init__(self, username, ip, endpoint, timestamp_text, timestamp_dt=None):
         self.username = username
         self.ip = ip
         self.endpoint = endpoint
         self.params = {}  # aggregated parameters
         self.first_seen = timestamp_text
         self.last_seen = timestamp_text
+        self.last_dt = timestamp_dt  # parsed last_seen (None if it could not be parsed)
+        self.heap_seq = None         # id of this item's current entry in MergeBuffer.heap
 
-    def merge(self, other_ts_text, other_params):
+    def merge(self, other_ts_text, other_params, other_dt=None):
         # update last_seen, merge params (existing keys keep first-seen value)
-        self.last_seen = other_ts_text or self.last_seen
+        if other_ts_text:
+            self.last_seen = other_ts_text
+            self.last_dt = other_dt
         for k, v in other_params.items():
             if k not in self.params:
                 self.params[k] = v
 
-def process_files(paths, db_path, report_csv_path):
-    # Open DB
-    conn = sqlite3.connect(db_path)
-    init_db(conn)
-    cur = conn.cursor()
+class MergeBuffer:
+    """
+    Open calls keyed by (username, ip, endpoint), with a min-heap of (last_seen, seq, key) entries so that
+    expiring old calls costs O(k log n) for k expired calls instead of re-parsing every open call.
+    Entries are invalidated lazily: an entry is live only while its seq equals the item's heap_seq, and the
+    heap is rebuilt once stale entries outnumber the live ones.
+    Calls whose last_seen could not be parsed are never expired (they are flushed at the end).
+    """
+    def __init__(self):
+        self.calls = {}
+        self.heap = []
+        self.seq = itertools.count()
 
-    # Buffer for merging multi-line calls.
-    # key -> CallBufferItem
-    open_calls = {}
+    def __len__(self):
+        return len(self.calls)
 
-    # For batching DB inserts
-    calls_to_insert = []
-    params_to_insert = []
+    def get(self, key):
+        return self.calls.get(key)
 
-    def flush_call_buffer_if_old(cutoff_dt):
-        # flush entries whose last_seen < cutoff_dt (ISO string compare is okay if format consistent)
-        nonlocal open_calls, calls_to_insert, params_to_insert
-        to_delete = []
-        for key, item in list(open_calls.items()):
-            # last_seen stored as text; try parse to datetime or compare using fallback
-            try:
-                last_dt = parse_iso_to_dt(item.last_seen)
-            except Exception:
-                # if cannot parse, flush anyway if it's older than cutoff by comparing strings
-                last_dt = None
-            if last_dt is not None:
-                if last_dt < cutoff_dt:
-                    # flush
-                    calls_to_insert.append((item.username or 'unknown', item.first_seen, item.ip or '', item.endpoint))
-                    # index is temporary, we'll assign call_id after insertion
-                    idx = len(calls_to_insert) - 1
-                    for pname, pval in item.params.items():
-                        params_to_insert.append((idx, pname, pval))
-                    to_delete.append(key)
-            else:
-                # if we can't compare, don't flush
-                pass
-        for k in to_delete:
-            open_calls.pop(k, None)
-
-    # Walk files list and yield lines
-    def iter_lines_from_paths(paths):
-        for p in paths:
-            if os.path.isdir(p):
-                for fname in sorted(os.listdir(p)):
-                    fpath = os.path.join(p, fname)
-                    if os.path.isfile(fpath):
-                        yield from iter_lines_from_file(fpath)
-            elif os.path.isfile(p):
-                yield from iter_lines_from_file(p)
-            else:
-                print(f"Warning: {p} is not a file or directory, skipping.", file=sys.stderr)
+    def values(self):
+        return self.calls.values()
 
-    def iter_lines_from_file(path):
-        with open(path, 'r', errors='ignore') as fh:
-            for line in fh:
-                yield line
-
-    def insert_batches():
-        nonlocal calls_to_insert, params_to_insert
-        if not calls_to_insert:
-            return
-        # Insert calls (we'll get inserted rowids to map params)
-        cur.executemany("INSERT INTO call (username, date_of_call, ip_address, endpoint) VALUES (?, ?, ?, ?);", calls_to_insert)
-        conn.commit()
-        # get last N rowids
-        last_rowid = cur.lastrowid
-        first_rowid = last_rowid - len(calls_to_insert) + 1
-        # map idx to real call_id
-        callid_map = {}
-        for idx in range(len(calls_to_insert)):
-            callid_map[idx] = first_rowid + idx
-        # prepare params insertion using real call ids
-        params_values = []
-        for idx, name, val in params_to_insert:
-            real_call_id = callid_map.get(idx)
-            if real_call_id:
-                params_values.append((real_call_id, name, val))
-        if params_values:
-            cur.executemany("INSERT INTO call_parameters (call_id, parameter_name, parameter_value) VALUES (?, ?, ?);", params_values)
-        conn.commit()
-        calls_to_insert = []
-        params_to_insert = []
+    def put(self, key, item):
+        self.calls[key] = item
+        self.touch(key, item)
 
-    # process streaming
-    processed_lines = 0
-    last_flush_time = datetime.utcnow()
-    for line in iter_lines_from_paths(paths):
-        processed_lines += 1
-        # quick find endpoints
-        m = RE_ENDPOINT.search(line)
-        if not m:
-            # still maybe this line contains username/ip/timestamp for merging — try extracting and merge
-            # but skip unless it has an endpoint elsewhere
-            continue
-        raw_path = m.group(0)
-        endpoint, params = normalize_endpoint_and_params(raw_path)
-        username = find_username(line) or 'unknown'
-        ip = find_first_ip(line) or ''
-        timestamp_text = parse_timestamp(line) or datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    def touch(self, key, item):
+        # (re)schedule item after its last_dt changed
+        item.heap_seq = next(self.seq)
+        if item.last_dt is not None:
+            heapq.heappush(self.heap, (utc_naive(item.last_dt), item.heap_seq, key))
+            if len(self.heap) > 2 * len(self.calls) + 1024:
+                self.heap = [e for e in self.heap if e[2] in self.calls and self.calls[e[2]].heap_seq == e[1]]
+                heapq.heapify(self.heap)
 
-        # Attach query params parsed from path and params collected
-        merged_params = dict(params)  # shallow copy
+    def add(self, username, ip, endpoint, params, timestamp_text, curr_dt):
+        """
+        Merge one extracted line into the open call for (username, ip, endpoint), or open a new call.
+        Returns the call it replaced because it was last seen more than MERGE_WINDOW_SECONDS earlier (it is
+        complete and has to be written), otherwise None.
+        """
+        # Attach query params parsed from path and params collected (interned copy)
+        endpoint, merged_params, username, ip = intern_call_fields(endpoint, params, username, ip)
 
         # Create key for merging
         key = (username, ip, endpoint)
 
         # merge behavior
-        existing = open_calls.get(key)
+        closed = None
+        existing = self.calls.get(key)
         if existing:
             # check time difference
             try:
-                last_dt = parse_iso_to_dt(existing.last_seen)
-                curr_dt = parse_iso_to_dt(timestamp_text)
                 if curr_dt is None:
                     # if cannot parse current ts, just update last_seen
                     existing.merge(timestamp_text, merged_params)
                 else:
-                    if (curr_dt - last_dt).total_seconds() <= MERGE_WINDOW_SECONDS:
-                        existing.merge(timestamp_text, merged_params)
+                    if (utc_naive(curr_dt) - utc_naive(existing.last_dt)).total_seconds() <= MERGE_WINDOW_SECONDS:
+                        existing.merge(timestamp_text, merged_params, curr_dt)
                     else:
                         # flush existing into DB and replace
-                        # append to calls_to_insert and params_to_insert
-                        calls_to_insert.append((existing.username or 'unknown', existing.first_seen, existing.ip or '', existing.endpoint))
-                        idx = len(calls_to_insert) - 1
-                        for pname, pval in existing.params.items():
-                            params_to_insert.append((idx, pname, pval))
+                        closed = existing
                         # replace with new item
-                        open_calls[key] = CallBufferItem(username, ip, endpoint, timestamp_text)
-                        open_calls[key].params.update(merged_params)
+                        existing = CallBufferItem(username, ip, endpoint, timestamp_text, curr_dt)
+                        existing.params.update(merged_params)
             except Exception:
                 # fallback: just merge
-                existing.merge(timestamp_text, merged_params)
+                existing.merge(timestamp_text, merged_params, curr_dt)
+            self.put(key, existing)
         else:
-            item = CallBufferItem(username, ip, endpoint, timestamp_text)
+            item = CallBufferItem(username, ip, endpoint, timestamp_text, curr_dt)
             item.params.update(merged_params)
-            open_calls[key] = item
+            self.put(key, item)
+        return closed
+
+    def expire(self, cutoff_dt):
+        # remove and return the calls last seen before cutoff_dt (naive UTC), oldest first
+        expired = []
+        while self.heap and self.heap[0][0] < cutoff_dt:
+            _, seq, key = heapq.heappop(self.heap)
+            item = self.calls.get(key)
+            if item is not None and item.heap_seq == seq:
+                del self.calls[key]
+                expired.append(item)
+        return expired
+
+    def pop_all(self):
+        items = list(self.calls.values())
+        self.calls.clear()
+        self.heap = []
+        return items
+
+ROUTE_CACHE_KEYS = 1 << 18  # --merge-shards: keys whose shard is remembered (the map starts over when full)
 
-        # Periodically flush buffer items older than MERGE_WINDOW_SECONDS
-        if processed_lines % 1000 == 0:
-            cutoff = datetime.utcnow() - timedelta(seconds=MERGE_WINDOW_SECONDS)
-            flush_call_buffer_if_old(cutoff)
+def run_merge_shard(pipe):
+    # merge shard process for ShardedMergeBuffer: owns the open calls of its keys and expires them itself.
+    # Every message gets one reply: (closed calls, number of open calls), the open calls themselves for
+    # 'finish' and (copies of them) for 'snapshot', or the exception that stopped the shard.
+    buffer = MergeBuffer()
+    try:
+        while True:
+            op, records, cutoff = pipe.recv()
+            closed = []
+            if op == 'load':
+                for item in records:
+                    buffer.put((item.username, item.ip, item.endpoint), item)
+                records = ()
+            for record_cutoff, username, ip, endpoint, params, timestamp_text, curr_dt in records:
+                if record_cutoff is not None:
+                    closed.extend(buffer.expire(record_cutoff))
+                item = buffer.add(username, ip, endpoint, params, timestamp_text, curr_dt)
+                if item is not None:
+                    closed.append(item)
+            if cutoff is not None:
+                closed.extend(buffer.expire(cutoff))
+            if op == 'finish':
+                pipe.send((closed, buffer.pop_all()))
+                return
+            pipe.send((closed, list(buffer.values()) if op == 'snapshot' else len(buffer)))
+    except Exception as exc:  # raised again in the main process
+        pipe.send(exc)
+
+class ShardedMergeBuffer:
+    """
+    --merge-shards: the merge buffer split over n processes by a hash of the (username, ip, endpoint) key.
+    Each shard (run_merge_shard) owns the open calls of its keys and their expiry, so the merging runs on n
+    cores while the main process only routes lines. All lines of a key go to the same shard in input order.
+    The event-time watermark stays global: cutoff is set by the caller whenever it moves, and a shard
+    expires with it before its next line, exactly where the in-process MergeBuffer would have expired.
+    Closed calls come back in batches: send() hands the routed lines to the shards and the next receive()
+    collects their replies, so the shards merge one chunk while the caller reads and routes the next.
+    Lines go out with the timestamp the caller already parsed for the watermark, and the shard of each key
+    is remembered (up to ROUTE_CACHE_KEYS keys), so routing a line is a dict lookup.
+    """
+    def __init__(self, n, items=(), cutoff=None):
+        # items and cutoff: an --incremental run's loaded open calls and the watermark cutoff they imply,
+        # which (like MergeBuffer) is only applied once the watermark moves
+        self.pipes, self.processes = [], []
+        for _ in range(n):
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=run_merge_shard, args=(child,), daemon=True)
+            process.start()
+            child.close()
+            self.pipes.append(parent)
+            self.processes.append(process)
+        self.cutoff = cutoff             # current watermark cutoff
+        self.sent_cutoff = [cutoff] * n  # cutoff each shard has expired with
+        self.outboxes = [[] for _ in range(n)]
+        self.sizes = [0] * n             # open calls per shard, as of the last replies
+        self.waiting = False             # replies to the last send() not received yet
+        self.routes = {}                 # (username, ip, endpoint) -> shard
+        loads = [[] for _ in range(n)]
+        for item in items:  # --incremental: calls left open by the previous run
+            loads[self.shard_of(item.username, item.ip, item.endpoint)].append(item)
+        for pipe, load in zip(self.pipes, loads):
+            pipe.send(('load', load, None))
+        self.waiting = True
+
+    def __len__(self):
+        return sum(self.sizes)
+
+    def shard_of(self, username, ip, endpoint):
+        # crc32 rather than hash(): str hashes change per process, and the shard order decides the call ids
+        key = f"{username}\0{ip}\0{endpoint}".encode('utf-8', 'surrogatepass')
+        return zlib.crc32(key) % len(self.pipes)
+
+    def add(self, username, ip, endpoint, params, timestamp_text, curr_dt):
+        key = (username, ip, endpoint)
+        i = self.routes.get(key)
+        if i is None:
+            if len(self.routes) >= ROUTE_CACHE_KEYS:
+                self.routes.clear()
+            i = self.routes[key] = self.shard_of(username, ip, endpoint)
+        cutoff = None
+        if self.sent_cutoff[i] != self.cutoff:
+            cutoff = self.sent_cutoff[i] = self.cutoff
+        self.outboxes[i].append((cutoff, username, ip, endpoint, params, timestamp_text, curr_dt))
+
+    def send(self, op='merge'):
+        # hand the routed lines (and the current cutoff) to every shard; receive() must come before the next
+        for i, pipe in enumerate(self.pipes):
+            pipe.send((op, self.outboxes[i], None if self.sent_cutoff[i] == self.cutoff else self.cutoff))
+            self.outboxes[i] = []
+            self.sent_cutoff[i] = self.cutoff
+        self.waiting = True
+
+    def _replies(self):
+        for pipe in self.pipes:
+            reply = pipe.recv()
+            if isinstance(reply, BaseException):
+                raise reply
+            yield reply
+
+    def receive(self):
+        # the calls the shards closed since the previous receive(), shard by shard
+        closed = []
+        if self.waiting:
+            self.waiting = False
+            for i, (items, size) in enumerate(self._replies()):
+                closed.extend(items)
+                self.sizes[i] = size
+        return closed
+
+    def expire(self, cutoff_dt):
+        # close the calls last seen before cutoff_dt in every shard now (--follow micro-batches)
+        closed = self.receive()
+        self.cutoff = cutoff_dt
+        self.send()
+        return closed + self.receive()
+
+    def snapshot(self):
+        # (closed calls, copies of the calls still open) after everything routed so far (--incremental commits)
+        closed = self.receive()
+        self.send('snapshot')
+        self.waiting = False
+        items = []
+        for i, (shard_closed, open_items) in enumerate(self._replies()):
+            closed.extend(shard_closed)
+            items.extend(open_items)
+            self.sizes[i] = len(open_items)
+        return closed, items
+
+    def finish(self):
+        # (closed calls, calls still open) after everything routed so far; stops the shard processes
+        closed = self.receive()
+        self.send('finish')
+        self.waiting = False
+        remaining = []
+        for items, open_items in self._replies():
+            closed.extend(items)
+            remaining.extend(open_items)
+        for process in self.processes:
+            process.join()
+        return closed, remaining
+
+class Watermark:
+    """
+    Event-time watermark for closing open calls: the newest log timestamp seen, minus the allowed lateness.
+    A call last seen more than MERGE_WINDOW_SECONDS before the watermark can no longer be merged into, so
+    merge results depend only on the log contents, not on the wall clock or on how fast logs are replayed.
+    """
+    def __init__(self, allowed_lateness=ALLOWED_LATENESS_SECONDS):
+        self.delay = timedelta(seconds=allowed_lateness + MERGE_WINDOW_SECONDS)
+        self.max_seen = None     # newest timestamp seen (naive UTC)
+        self.max_seen_at = None  # time.monotonic() when it was seen
+
+    def observe(self, dt):
+        # returns True if the watermark moved forward
+        dt = utc_naive(dt)
+        if self.max_seen is None or dt > self.max_seen:
+            self.max_seen = dt
+            self.max_seen_at = time.monotonic()
+            return True
+        return False
+
+    def cutoff(self, idle=False):
+        """
+        Calls last seen before this can be closed (None until a timestamp was seen).
+        idle=True (--follow) also counts the wall-clock time since the newest line arrived, so calls still
+        close while the logs are quiet.
+        """
+        if self.max_seen is None:
+            return None
+        cutoff = self.max_seen - self.delay
+        if idle:
+            cutoff += timedelta(seconds=time.monotonic() - self.max_seen_at)
+        return cutoff
+
+def load_open_calls(conn):
+    # take over the merge buffer saved by the previous --incremental run
+    open_calls = MergeBuffer()
+    for username, ip, endpoint, first_seen, last_seen, params in conn.execute(
+            "SELECT username, ip_address, endpoint, first_seen, last_seen, params FROM open_call;"):
+        item = CallBufferItem(username, ip, endpoint, first_seen)
+        item.merge(last_seen, json.loads(params), parse_iso_to_dt(last_seen))
+        open_calls.put((username, ip, endpoint), item)
+    return open_calls
+
+def open_call_rows(items):
+    # open_call rows for CallBufferItems (a snapshot: the items can change once this returns)
+    return [(item.username, item.ip, item.endpoint, item.first_seen, item.last_seen, json.dumps(item.params),
+             call_time_columns(item.first_seen)[1]) for item in items]
+
+def save_open_calls(conn, rows):
+    # replace the saved merge buffer with open_call_rows(...)
+    conn.execute("DELETE FROM open_call;")
+    conn.executemany("INSERT INTO open_call (username, ip_address, endpoint, first_seen, last_seen, params, call_date) "
+                     "VALUES (?, ?, ?, ?, ?, ?, ?);", rows)
+
+def process_files(paths, db_path, report_csv_path, workers=1, use_mmap=False, readahead=False, incremental=False,
+                  follow=False, commit_interval=FOLLOW_COMMIT_SECONDS, stop=None,
+                  allowed_lateness=ALLOWED_LATENESS_SECONDS, bulk_load=False, columnar_dir=None,
+                  columnar_format='parquet', normalized_schema=False, progress_interval=PROGRESS_SECONDS,
+                  stats_json=None, writer_thread=False, log_format='heuristic', merge_shards=1,
+                  dedup=False, partition=None, retain_days=None):
+    run_start = time.perf_counter()
+    stats = StageStats()
+    cache_before = normalize_cached.cache_info()  # lookups in this process (--workers count theirs in scan_shard)
+    # Open DB (--writer-thread: used by the writer thread while it runs, then by this one again)
+    conn = sqlite3.connect(db_path, check_same_thread=not writer_thread)
+    normalized = init_db(conn, create_indexes=not bulk_load, normalized=normalized_schema, partition=partition)
+    cur = conn.cursor()
+    call_writer = CallWriter(conn, bulk_load, normalized, dedup, retain_days, incremental)
+    # --columnar-dir: the same batches also go to partitioned Parquet / Arrow files
+    columnar_sink = ColumnarSink(columnar_dir, columnar_format) if columnar_dir else None
+
+    # Buffer for merging multi-line calls.
+    # key -> CallBufferItem
+    open_calls = MergeBuffer()
+
+    watermark = Watermark(allowed_lateness)
+
+    # --incremental: only read what is new since the last run, and pick up its merge buffer
+    ranges = checkpoints = None
+    if incremental:
+        ranges, checkpoints = plan_incremental_ranges(conn, list(iter_input_files(paths)))
+        open_calls = load_open_calls(conn)
+        for item in open_calls.values():
+            if item.last_dt is not None:
+                watermark.observe(item.last_dt)
+    # --merge-shards: merge in that many processes instead (handed back as a MergeBuffer after the input)
+    sharded = merge_shards > 1
+    if sharded:
+        open_calls = ShardedMergeBuffer(merge_shards, open_calls.pop_all(), watermark.cutoff())
+
+    # For batching DB inserts
+    calls_to_insert = []
+    params_to_insert = []
+
+    def queue_call(item):
+        calls_to_insert.append((item.username or 'unknown', item.first_seen, item.ip or '', item.endpoint)
+                               + call_time_columns(item.first_seen))
+        # params refer to the call by its index in the batch; CallWriter maps it to the reserved call id
+        idx = len(calls_to_insert) - 1
+        for pname, pval in item.params.items():
+            params_to_insert.append((idx, pname, pval))
+
+    def flush_call_buffer_if_old(cutoff_dt):
+        # flush entries whose last_seen < cutoff_dt; entries with an unparseable last_seen stay
+        if cutoff_dt is None:
+            return
+        t = time.perf_counter()
+        for item in open_calls.expire(cutoff_dt):
+            queue_call(item)
+        stats.add('flush', time.perf_counter() - t)
+
+    def write_batch(calls, params):
+        if call_writer.dedup is not None:
+            t = time.perf_counter()
+            n = len(calls)
+            calls, params = call_writer.dedup.drop_duplicates(calls, params)
+            stats.count('duplicate_calls', n - len(calls))
+            stats.add('dedup', time.perf_counter() - t)
+        t = time.perf_counter()
+        first_id = call_writer.write(calls, params)
+        stats.add('db_insert', time.perf_counter() - t)
+        stats.count('db_rows', len(calls))
+        if columnar_sink is not None and calls:
+            t = time.perf_counter()
+            columnar_sink.write(first_id, calls, params)
+            stats.add('columnar', time.perf_counter() - t)
+
+    def timed(stage, fn, *args):
+        t = time.perf_counter()
+        fn(*args)
+        stats.add(stage, time.perf_counter() - t)
+
+    # --writer-thread: batches and commits go to a BackgroundWriter; time blocked on its queue is 'writer_wait'
+    background = BackgroundWriter() if writer_thread else None
+
+    def insert_batches():
+        nonlocal calls_to_insert, params_to_insert
+        if background is None:
+            write_batch(calls_to_insert, params_to_insert)
+        elif calls_to_insert:
+            timed('writer_wait', background.submit, write_batch, calls_to_insert, params_to_insert)
+        calls_to_insert = []
+        params_to_insert = []
+
+    def commit_with_state(state):
+        if state is not None:
+            save_open_calls(conn, state[0])
+            save_checkpoints(conn, state[1])
+        call_writer.commit()
+
+    def commit(state=None):
+        # state: --incremental (open_call rows, checkpoints) to store in the same transaction as the calls
+        if background is None:
+            timed('db_insert', commit_with_state, state)
+        else:
+            timed('writer_wait', background.submit, timed, 'db_insert', commit_with_state, state)
+
+    def incremental_state():
+        # --follow --incremental micro-batch: the open calls and read positions as of the lines merged so far
+        if sharded:
+            closed, items = open_calls.snapshot()
+            for item in closed:
+                queue_call(item)
+        else:
+            items = open_calls.values()
+        latest = {t.path: t.checkpoint() for t in tailed if t.fh is not None}
+        return open_call_rows(items), [latest.get(cp[0], cp) for cp in checkpoints]
+
+    # stages that merge_record can run into on this thread (they are not counted as merge time)
+    inline_stages = ('flush', 'writer_wait') if background else ('flush', 'dedup', 'db_insert', 'columnar')
+
+    def nested_seconds():
+        return sum(stats.seconds.get(stage, 0.0) for stage in inline_stages)
+
+    def event_time(timestamp_text):
+        # (timestamp_text, parsed, whether the watermark moved forward) for one extracted line
+        if timestamp_text is None:
+            # no timestamp in the line: stamp it with the current time, but keep it out of the watermark
+            timestamp_text = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+            return timestamp_text, parse_iso_to_dt(timestamp_text), False
+        curr_dt = parse_iso_to_dt(timestamp_text)
+        return timestamp_text, curr_dt, curr_dt is not None and watermark.observe(curr_dt)
+
+    def merge_record(endpoint, params, username, ip, timestamp_text):
+        timestamp_text, curr_dt, advanced = event_time(timestamp_text)
+        closed = open_calls.add(username, ip, endpoint, params, timestamp_text, curr_dt)
+        if closed is not None:
+            queue_call(closed)
+
+        # Close calls that fell behind the event-time watermark (a heap peek when nothing expired)
+        if advanced:
+            flush_call_buffer_if_old(watermark.cutoff())
 
         # Periodically insert batches to DB
         if len(calls_to_insert) >= DB_BATCH_SIZE:
             insert_batches()
 
+    def route_record(endpoint, params, username, ip, timestamp_text):
+        # --merge-shards: the shard owning the key merges the line; like merge_record, a cutoff moved by this
+        # line is only applied after it
+        timestamp_text, curr_dt, advanced = event_time(timestamp_text)
+        open_calls.add(username, ip, endpoint, params, timestamp_text, curr_dt)
+        if advanced:
+            open_calls.cutoff = watermark.cutoff()
+
+    # process streaming
+    chunks = iter_record_chunks(paths, workers, use_mmap=use_mmap, readahead=readahead, ranges=ranges, stats=stats,
+                                log_format=log_format)
+    tailed = []
+    caught_up = True  # --follow --incremental: only commit once the catch-up chunks are merged
+    if follow:
+        # --follow: tail the plain inputs after the catch-up above (with --incremental) or from their end
+        files = [p for p in iter_input_files(paths) if detect_compression(p) is None]
+        if incremental:
+            offsets = {cp[0]: cp[4] for cp in checkpoints}
+            tailed = [TailedFile(p, offsets[p], log_format) for p in files]
+            caught_up = False
+        else:
+            chunks = iter(())
+            tailed = [TailedFile(p, log_format=log_format) for p in files]
+        if stop is None:
+            stop = threading.Event()
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                signal.signal(sig, lambda signum, frame: stop.set())
+
+        def follow_chunks():
+            nonlocal caught_up
+            caught_up = True
+            yield from follow_record_chunks(tailed, stop, stats=stats)
+        chunks = itertools.chain(chunks, follow_chunks())
+    processed_lines = 0
+    last_commit = time.monotonic()
+    next_progress = time.monotonic() + progress_interval
+    for line_count, records in chunks:
+        t, nested = time.perf_counter(), nested_seconds()
+        for _, endpoint, params, username, ip, timestamp_text in records:
+            (route_record if sharded else merge_record)(endpoint, params, username, ip, timestamp_text)
+        stats.add('merge', time.perf_counter() - t - (nested_seconds() - nested))
+        stats.count('matched_lines', len(records))
+        if sharded:
+            # collect what the shards closed from the previous chunk, then pass them this one
+            t = time.perf_counter()
+            closed = open_calls.receive()
+            open_calls.send()
+            stats.add('merge_wait', time.perf_counter() - t)
+            for item in closed:
+                queue_call(item)
+            if len(calls_to_insert) >= DB_BATCH_SIZE:
+                insert_batches()
+        processed_lines += line_count
+        if follow and caught_up and time.monotonic() - last_commit >= commit_interval:
+            # micro-batch: close calls idle for longer than the merge window and commit what we have
+            flush_call_buffer_if_old(watermark.cutoff(idle=True))
+            state = incremental_state() if incremental else None
+            insert_batches()
+            commit(state)
+            last_commit = time.monotonic()
+        if progress_interval and time.monotonic() >= next_progress:
+            print(stats.progress_line(time.perf_counter() - run_start, len(open_calls)), file=sys.stderr)
+            next_progress = time.monotonic() + progress_interval
+    if tailed:
+        if incremental:
+            latest = {t.path: t.checkpoint() for t in tailed if t.fh is not None}
+            checkpoints = [latest.get(cp[0], cp) for cp in checkpoints]
+        for t in tailed:
+            t.close()
+    if sharded:
+        t = time.perf_counter()
+        closed, remaining = open_calls.finish()
+        stats.add('merge_wait', time.perf_counter() - t)
+        for item in closed:
+            queue_call(item)
+        open_calls = MergeBuffer()
+        for item in remaining:
+            open_calls.put((item.username, item.ip, item.endpoint), item)
+
     # After loop, flush all remaining open_calls
-    for key, item in open_calls.items():
-        calls_to_insert.append((item.username or 'unknown', item.first_seen, item.ip or '', item.endpoint))
-        idx = len(calls_to_insert) - 1
-        for pname, pval in item.params.items():
-            params_to_insert.append((idx, pname, pval))
-    open_calls.clear()
+    # (--incremental keeps them in open_call instead, so the next run can still merge into them)
+    if not incremental:
+        t = time.perf_counter()
+        for item in open_calls.pop_all():
+            queue_call(item)
+        stats.add('flush', time.perf_counter() - t)
     # final insert
     insert_batches()
+    if background is not None:
+        timed('writer_wait', background.close)  # the connection is this thread's again
+    t = time.perf_counter()
+    if incremental:
+        # in the transaction that commits the calls (CallWriter(incremental=True) left it open)
+        save_open_calls(conn, open_call_rows(open_calls.values()))
+        save_checkpoints(conn, checkpoints)
+    call_writer.finish()
+    stats.add('db_insert', time.perf_counter() - t)
+    if columnar_sink is not None:
+        timed('columnar', columnar_sink.close)
 
-    # Generate report: username, date, endpoint, number_of_calls (date derived from date_of_call)
-    # We'll try to extract date portion (YYYY-MM-DD) from date_of_call strings
-    # Using SQL substr to get first 10 characters is sufficient for ISO-like forms
+    # Generate report: username, date, endpoint, number_of_calls (date is call_date, the UTC day of the call)
+    # Read from the call_daily_summary rollup, so this is O(groups) rather than O(calls)
+    t = time.perf_counter()
     with open(report_csv_path, 'w', newline='', encoding='utf-8') as csvfile:
         writer = csv.writer(csvfile)
         writer.writerow(['username', 'date', 'endpoint', 'number_of_calls'])
+        # calls still held in open_call by an --incremental run are counted too
         q = """
-        SELECT username, substr(date_of_call,1,10) as date, endpoint, COUNT(*) as cnt
-        FROM call
+        SELECT username, date, endpoint, SUM(cnt) as cnt
+        FROM (SELECT username, date, endpoint, number_of_calls AS cnt FROM call_daily_summary
+              UNION ALL
+              SELECT username, IFNULL(call_date, ''), endpoint, 1 FROM open_call)
         GROUP BY username, date, endpoint
         ORDER BY username, date, endpoint;
         """
         for row in cur.execute(q):
             writer.writerow(row)
+    stats.add('report', time.perf_counter() - t)
 
     conn.close()
     print(f"Done. Processed approx {processed_lines} lines. Report saved to {report_csv_path} and DB to {db_path}.")
+    print(stats.summary_line())
+    if call_writer.dedup is not None:
+        print(f"Dedup: {stats.counters['duplicate_calls']} duplicate calls skipped.")
+    count_normalize_cache(stats, cache_before)
+    hits, misses = stats.counters['normalize_hits'], stats.counters['normalize_misses']
+    if hits + misses:
+        # summed over the worker processes with --workers (each has its own cache)
+        print(f"Endpoint normalization cache: {hits} hits, {misses} misses ({hits / (hits + misses):.1%} hit rate).")
+    if stats_json:
+        run_stats = stats.as_dict(time.perf_counter() - run_start)
+        with open(stats_json, 'w', encoding='utf-8') as fh:
+            json.dump(run_stats, fh, indent=2)
+    return stats
+
+# ---------------------------
+# Queries
+# ---------------------------
+QUERY_KINDS = ('top-endpoints', 'users', 'tickers', 'histogram')
+
+def query_calls(conn, kind, since=None, until=None, username=None, endpoint=None, limit=None, bucket='hour'):
+    """
+    Aggregate queries for the 'query' subcommand, answered from the SUMMARY_TABLES rollups.
+    Returns (header, rows). since / until are inclusive 'YYYY-MM-DD' call dates (UTC).
+     - top-endpoints: calls per endpoint, busiest first (limit defaults to 10)
+     - users: calls per username, busiest first
+     - tickers: calls per ticker parameter, busiest first
+     - histogram: calls per time bucket: 'day' and 'hour' come from the rollups, 'minute' is counted from the
+       call table through idx_call_epoch
+    Calls still held in open_call by --incremental are not included.
+    """
+    if kind == 'top-endpoints':
+        table, label, header = 'call_daily_summary', 'endpoint', ['endpoint', 'number_of_calls']
+        limit = limit or 10
+    elif kind == 'users':
+        table, label, header = 'call_daily_summary', 'username', ['username', 'number_of_calls']
+    elif kind == 'tickers':
+        table, label, header = 'ticker_daily_summary', 'ticker', ['ticker', 'number_of_calls']
+    elif kind == 'histogram' and bucket == 'day':
+        table, label, header = 'call_daily_summary', 'date', ['day', 'number_of_calls']
+    elif kind == 'histogram' and bucket == 'hour':
+        table, label, header = 'call_hourly_summary', "date || printf(' %02d:00', hour)", ['hour', 'number_of_calls']
+    elif kind == 'histogram' and bucket == 'minute':
+        table, label, header = 'call', "strftime('%Y-%m-%d %H:%M', call_epoch / 60 * 60, 'unixepoch')", ['minute', 'number_of_calls']
+    else:
+        raise ValueError(f"unknown query {kind!r} (bucket {bucket!r})")
+    date_column = 'call_date' if table == 'call' else 'date'
+    count = 'COUNT(*)' if table == 'call' else 'SUM(number_of_calls)'
+    where, args = [], []
+    for clause, value in ((f"{date_column} >= ?", since), (f"{date_column} <= ?", until),
+                          ("username = ?", username), ("endpoint = ?", endpoint)):
+        if value is None:
+            continue
+        if clause.startswith('username') and table not in ('call_daily_summary', 'call'):
+            hint = " (use --bucket day or minute)" if kind == 'histogram' else ""
+            raise ValueError(f"{kind} cannot be filtered by user{hint}")
+        where.append(clause)
+        args.append(value)
+    if table == 'call':
+        where.append("call_epoch IS NOT NULL")
+    elif kind == 'histogram':
+        where.append(f"date <> '{UNDATED}'")
+    sql = f"SELECT {label}, {count} FROM {table}"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " GROUP BY 1 ORDER BY " + ("1" if kind == 'histogram' else "2 DESC, 1")
+    if limit:
+        sql += f" LIMIT {int(limit)}"
+    return header, conn.execute(sql + ";", args).fetchall()
+
+def query_main(argv):
+    parser = argparse.ArgumentParser(prog='Activity_TDD.py query',
+                                     description="Aggregate queries over a processed call database")
+    parser.add_argument('kind', choices=QUERY_KINDS, help='what to count')
+    parser.add_argument('--db', default='processed_calls.db', help='sqlite db path')
+    parser.add_argument('--since', help='first call date, YYYY-MM-DD (UTC)')
+    parser.add_argument('--until', help='last call date, YYYY-MM-DD (UTC)')
+    parser.add_argument('--user', help='only calls by this username')
+    parser.add_argument('--endpoint', help='only calls to this (normalized) endpoint')
+    parser.add_argument('--limit', type=int, help='at most this many rows')
+    parser.add_argument('--bucket', choices=['minute', 'hour', 'day'], default='hour', help='histogram bucket size')
+    args = parser.parse_args(argv)
+    if not os.path.exists(args.db):
+        parser.error(f"no database at {args.db}")
+    conn = connect_read_only(args.db)  # queries never write, so they do not wait for (or block) a running load
+    missing = [name for name in SUMMARY_TABLES
+               if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?;", (name,)).fetchone() is None]
+    if missing:
+        parser.error(f"{args.db} has no {', '.join(missing)} rollup; process any input into it once to build it")
+    try:
+        header, rows = query_calls(conn, args.kind, args.since, args.until, args.user, args.endpoint, args.limit,
+                                   args.bucket)
+    except ValueError as exc:
+        parser.error(str(exc))
+    writer = csv.writer(sys.stdout)
+    writer.writerow(header)
+    writer.writerows(rows)
+    conn.close()
+
+# ---------------------------
+# Timestamp parsing
+# ---------------------------
+# parse_iso_to_dt runs for every call line, so it avoids strptime: the layout is recognised from a few
+# fixed character positions, fields are sliced out as ints, and the naive datetime for each distinct
+# 'YYYY-MM-DD?HH:MM:SS' second is cached (log lines arrive many per second).
+TS_CACHE_SIZE = 100000  # distinct seconds kept; the cache is simply cleared when full
+MONTHS = {name: i for i, name in enumerate(
+    ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'), 1)}
+RE_TZ_OFFSET = re.compile(r'([+\-])(\d{2}):?(\d{2})')
+_second_cache = {}
+_tz_cache = {'Z': timezone.utc}
+
+def parse_second(head):
+    # 'YYYY-MM-DD?HH:MM:SS' (any separators, already checked by the caller) -> naive datetime, cached
+    dt = _second_cache.get(head)
+    if dt is None:
+        try:
+            dt = datetime(int(head[0:4]), int(head[5:7]), int(head[8:10]),
+                          int(head[11:13]), int(head[14:16]), int(head[17:19]))
+        except ValueError:
+            return None
+        if len(_second_cache) >= TS_CACHE_SIZE:
+            _second_cache.clear()
+        _second_cache[head] = dt
+    return dt
+
+def parse_tz(suffix):
+    # 'Z', '+02:00' or '-0500' -> tzinfo (cached), None if not an offset (or out of range, like strptime's %z)
+    tz = _tz_cache.get(suffix)
+    if tz is None:
+        m = RE_TZ_OFFSET.fullmatch(suffix)
+        if not m or int(m.group(2)) >= 24 or int(m.group(3)) >= 60:
+            return None
+        offset = timedelta(hours=int(m.group(2)), minutes=int(m.group(3)))
+        tz = timezone(-offset if m.group(1) == '-' else offset)
+        _tz_cache[suffix] = tz
+    return tz
+
+def apache_to_dt(text):
+    # '10/Oct/2000:13:55:36' -> naive datetime
+    month = MONTHS.get(text[3:6].title())
+    if month is None or text[2] != '/' or text[6] != '/' or text[11] != ':':
+        return None
+    try:
+        return datetime(int(text[7:11]), month, int(text[0:2]),
+                        int(text[12:14]), int(text[15:17]), int(text[18:20]))
+    except ValueError:
+        return None
+
+def utc_naive(dt):
+    # comparable form for expiry: offset-aware datetimes are converted to naive UTC
+    if dt.tzinfo is not None:
+        return dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+UNIX_EPOCH = datetime(1970, 1, 1)
+
+def call_time_columns(date_of_call):
+    """
+    (call_epoch, call_date) stored next to date_of_call: UTC epoch seconds and the UTC 'YYYY-MM-DD' date,
+    whatever format the log used (naive timestamps are taken as UTC). Unparseable text gets neither
+    (UNDATED in the rollups and the report).
+    """
+    dt = parse_iso_to_dt(date_of_call)
+    if dt is None:
+        return None, None
+    dt = utc_naive(dt)
+    return (dt - UNIX_EPOCH) // timedelta(seconds=1), f"{dt.year:04d}-{dt.month:02d}-{dt.day:02d}"
 
 # utility to parse ISO-like into datetime object (best-effort)
 def parse_iso_to_dt(text):
+    """
+    Accepts what parse_timestamp produces:
+      'YYYY-MM-DDTHH:MM:SS[.fff][Z|+hh:mm|+hhmm]', 'YYYY-MM-DD HH:MM:SS', 'YYYY/MM/DD HH:MM:SS',
+    or text containing an Apache 'DD/Mon/YYYY:HH:MM:SS' stamp. Returns None for anything else.
+    """
     if not text:
         return None
-    # Try several patterns
-    for fmt in ('%Y-%m-%dT%H:%M:%S%z', '%Y-%m-%dT%H:%M:%S.%f%z',
-                '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S',
-                '%Y/%m/%d %H:%M:%S'):
-        try:
-            # Handle naive timezoneless strings
-            if fmt.endswith('%z') and (text.endswith('Z') or ('+' in text or '-' in text[10:])):
-                # normalize Z -> +0000
-                t = text.replace('Z', '+0000')
-                # remove colon in offset if exists like +02:00 -> +0200
-                t = re.sub(r'([+\-]\d{2}):(\d{2})$', r'\1\2', t)
-                return datetime.strptime(t, fmt)
-            else:
-                return datetime.strptime(text, fmt)
-        except Exception:
-            continue
+    n = len(text)
+    if n >= 19 and text[13] == ':' and text[16] == ':' and text[:4].isdigit():
+        sep = text[10]
+        if text[4] == '-' and text[7] == '-':
+            if sep == ' ' and n == 19:
+                return parse_second(text)
+            if sep == 'T':
+                dt = parse_second(text[:19])
+                if dt is None or n == 19:
+                    return dt
+                rest = text[19:]
+                if rest[0] == '.':
+                    i = 1
+                    while i < len(rest) and rest[i].isdigit():
+                        i += 1
+                    if i == 1:
+                        return None
+                    dt = dt.replace(microsecond=int(rest[1:i][:6].ljust(6, '0')))
+                    rest = rest[i:]
+                if rest:
+                    tz = parse_tz(rest)
+                    if tz is None:
+                        return None
+                    dt = dt.replace(tzinfo=tz)
+                return dt
+        elif text[4] == '/' and text[7] == '/' and sep == ' ' and n == 19:
+            return parse_second(text)
     # Try apache style
-    try:
-        if RE_APACHE.search(text):
-            m = RE_APACHE.search(text).group(1)
-            dt = datetime.strptime(m, '%d/%b/%Y:%H:%M:%S')
-            return dt
-    except Exception:
-        pass
+    m = RE_APACHE.search(text)
+    if m:
+        return apache_to_dt(m.group(1))
     return None
 
 # ---------------------------
 # Unit tests for parsing helpers
 # ---------------------------
+import gc
+import operator
+import pickle
+import tempfile
 import unittest
+from unittest import mock
 
 class TestParsingLogic(unittest.TestCase):
     def test_normalize_simple(self):
@@ -474,6 +2790,41 @@ class TestParsingLogic(unittest.TestCase):
         s = 'client 10.20.30.40 connected'
         self.assertEqual(find_first_ip(s), '10.20.30.40')
 
+    def test_scan_fields_matches_helpers(self):
+        lines = SAMPLE_LOG_LINES + [
+            'x user=10.0.0.9 from 10.0.0.1 at 2024-01-01T00:00:00Z /new/endpoint01/',
+            '{"user": "u=bob"} 2023-05-01 00:00:00 1.1.1.1',
+            'menu=1 a@b.com 1.2.3.4 2024/01/02 03:04:05',
+            'USER="Q" 2024-01-01 00:00:00 2024-01-01T00:00:00',
+            'no fields here',
+            'GET /new/endpoint01/ u=2024/03/01 10:00:00 10.0.0.1',
+            'x.y@ex.comu=10.0.0.1 GET /new/endpoint01/ 2024-03-01 10:00:00',
+        ]
+        self.assertEqual(scan_fields(lines[-2])[2], '2024/03/01 10:00:00')
+        for line in lines:
+            self.assertEqual(scan_fields(line), (find_username(line), find_first_ip(line), parse_timestamp(line)), line)
+
+    def test_normalize_cached(self):
+        raw = '/new/endpoint09/CFO?date=current'
+        endpoint, params = normalize_cached(raw)
+        self.assertEqual((endpoint, params), normalize_endpoint_and_params(raw))
+        self.assertIs(normalize_cached(raw)[1], params)
+        with self.assertRaises(TypeError):
+            params['date'] = 'other'
+        self.assertEqual(pickle.loads(pickle.dumps(params)), params)
+
+    def test_log_format_parsers(self):
+        nginx = ('10.0.0.2 - bob [01/Mar/2024:10:00:07 +0000] "GET /old/endpoint01/SPY?d=2024-01-01T00:00:00 HTTP/1.1" '
+                 '200 5 "-" "x"\n')
+        self.assertEqual(parse_nginx(nginx), ('/old/endpoint01/SPY', 'bob', '10.0.0.2', '2024-03-01 10:00:07'))
+        self.assertEqual(parse_nginx(nginx.replace('/old/endpoint01/', '/static/')), NOT_A_CALL)
+        self.assertEqual(parse_app(SAMPLE_LOG_LINES[0]),
+                         ('/new/endpoint05/ARKK/top', 'alice', '10.0.0.1', '2024-03-01 10:00:00'))
+        jsonl = '{"ts": 1709287207, "remote_addr": "10.0.0.3", "username": "carol", "url": "/new/endpoint10/"}\n'
+        self.assertEqual(parse_jsonl(jsonl), ('/new/endpoint10/', 'carol', '10.0.0.3', '2024-03-01 10:00:07'))
+        for parse in LOG_FORMATS.values():
+            self.assertIsNone(parse('2024-03-01 10:00:01 heartbeat ok /new/endpoint01/\n'))
+
     def test_parse_query_params(self):
         qs = 'a=1&b=two&flag'
         p = parse_query_params(qs)
@@ -481,18 +2832,549 @@ class TestParsingLogic(unittest.TestCase):
         self.assertEqual(p['b'], 'two')
         self.assertEqual(p['flag'], '')
 
+SAMPLE_LOG_LINES = [
+    '2024-03-01 10:00:00 10.0.0.1 {"user": "alice"} GET /new/endpoint05/ARKK/top?date=current 200\n',
+    '2024-03-01 10:00:01 heartbeat ok\n',
+    '2024-03-01 10:00:05 10.0.0.1 {"user": "alice"} GET /new/endpoint05/ARKK/top?limit=5 200\n',
+    '10.0.0.2 - - [01/Mar/2024:10:00:07 +0000] "GET /old/endpoint01/ HTTP/1.1" 200 user=bob@example.com\n',
+    '2024/03/01 10:01:30 10.0.0.1 {"user": "alice"} GET /new/endpoint09/CFO?date=current 200\n',
+]
+
+class TestProcessFiles(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def write_log(self, name, lines):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, 'w') as fh:
+            fh.writelines(lines)
+        return path
+
+    def flatten(self, chunks):
+        total, records = 0, []
+        for line_count, recs in chunks:
+            records.extend((total + r[0],) + r[1:] for r in recs)
+            total += line_count
+        return total, records
+
+    def test_plan_shards_cut_on_newlines(self):
+        path = self.write_log('a.log', SAMPLE_LOG_LINES * 20)
+        shards = plan_shards(path, 100)
+        self.assertEqual(shards[0][1], 0)
+        self.assertEqual(shards[-1][2], os.path.getsize(path))
+        with open(path, 'rb') as fh:
+            data = fh.read()
+        for (_, _, end), (_, start, _) in zip(shards, shards[1:]):
+            self.assertEqual(end, start)
+            self.assertEqual(data[end - 1:end], b'\n')
+
+    def test_mmap_records_match_text_mode(self):
+        a = self.write_log('a.log', SAMPLE_LOG_LINES * 50)
+        b = self.write_log('b.log', [l.replace('\n', '\r\n') for l in SAMPLE_LOG_LINES] + ['2024-03-01 11:00:00 /new/endpoint01/ no newline'])
+        self.assertEqual(self.flatten(iter_record_chunks([a, b])),
+                         self.flatten(iter_record_chunks([a, b], use_mmap=True)))
+        self.assertEqual(self.flatten(iter_record_chunks([a, b])),
+                         self.flatten(iter_record_chunks([a, b], workers=2, shard_size=300, use_mmap=True)))
+
+    def test_compressed_inputs(self):
+        plain = self.write_log('plain.log', SAMPLE_LOG_LINES * 10)
+        expected = self.flatten(iter_record_chunks([plain]))
+        data = ''.join(SAMPLE_LOG_LINES * 10).encode()
+        for name, compress in (('a.log.gz', gzip.compress), ('b.log.bz2', bz2.compress), ('c.log.xz', lzma.compress)):
+            path = os.path.join(self.tmpdir.name, name)
+            with open(path, 'wb') as fh:
+                fh.write(compress(data))
+            self.assertEqual(self.flatten(iter_record_chunks([path])), expected)
+            self.assertEqual(self.flatten(iter_record_chunks([path], readahead=True, use_mmap=True)), expected)
+
+    def test_incremental_ranges_only_cover_new_data(self):
+        path = self.write_log('app.log', SAMPLE_LOG_LINES[:2] + ['2024-03-01 10:00:02 partial'])
+        conn = sqlite3.connect(':memory:')
+        init_db(conn)
+        ranges, checkpoints = plan_incremental_ranges(conn, [path])
+        first_end = len(''.join(SAMPLE_LOG_LINES[:2]).encode())
+        self.assertEqual(ranges, [(path, 0, first_end)])
+        save_checkpoints(conn, checkpoints)
+        with open(path, 'a') as fh:
+            fh.write(' line\n')
+        ranges, checkpoints = plan_incremental_ranges(conn, [path])
+        self.assertEqual(ranges, [(path, first_end, os.path.getsize(path))])
+        save_checkpoints(conn, checkpoints)
+        # rotated away under a new name: nothing new in it
+        rotated = path + '.1'
+        os.rename(path, rotated)
+        self.assertEqual(plan_incremental_ranges(conn, [rotated])[0], [])
+        # truncated in place: read again from the start
+        with open(rotated, 'w') as fh:
+            fh.write(SAMPLE_LOG_LINES[0])
+        self.assertEqual(plan_incremental_ranges(conn, [rotated])[0], [(rotated, 0, len(SAMPLE_LOG_LINES[0]))])
+
+    def test_open_calls_round_trip(self):
+        conn = sqlite3.connect(':memory:')
+        init_db(conn)
+        item = CallBufferItem('alice', '10.0.0.1', '/new/endpoint05/', '2024-03-01 10:00:00')
+        item.merge('2024-03-01 10:00:05', {'ticker': 'ARKK'})
+        save_open_calls(conn, open_call_rows([item]))
+        loaded = load_open_calls(conn)
+        got = loaded.get(('alice', '10.0.0.1', '/new/endpoint05/'))
+        self.assertEqual((got.first_seen, got.last_seen, got.params), (item.first_seen, item.last_seen, item.params))
+        save_open_calls(conn, [])  # replaces what was saved before
+        self.assertEqual(len(load_open_calls(conn)), 0)
+
+    def test_parse_iso_to_dt_formats(self):
+        utc, plus2 = timezone.utc, timezone(timedelta(hours=2))
+        cases = {
+            '2024-03-01T10:00:05': datetime(2024, 3, 1, 10, 0, 5),
+            '2024-03-01T10:00:05Z': datetime(2024, 3, 1, 10, 0, 5, tzinfo=utc),
+            '2024-03-01T10:00:05+02:00': datetime(2024, 3, 1, 10, 0, 5, tzinfo=plus2),
+            '2024-03-01T10:00:05.25+0200': datetime(2024, 3, 1, 10, 0, 5, 250000, tzinfo=plus2),
+            '2024-03-01T10:00:05.1234567': datetime(2024, 3, 1, 10, 0, 5, 123456),
+            '2024-03-01 10:00:05': datetime(2024, 3, 1, 10, 0, 5),
+            '2024/03/01 10:00:05': datetime(2024, 3, 1, 10, 0, 5),
+            '[01/mar/2024:10:00:05 +0000]': datetime(2024, 3, 1, 10, 0, 5),
+            '2024-02-30 10:00:05': None,
+            '2024-03-01 10:00:05+02:00': None,
+            '2024-03-01T10:00:05+99:00': None,
+            '2024-03-01T10:00:05+2400': None,
+            '2024-03-01T10:00:05+02:99': None,
+            '2024-03-01T10:00:05-23:59': datetime(2024, 3, 1, 10, 0, 5, tzinfo=timezone(-timedelta(hours=23, minutes=59))),
+            '2024-03-01T10:00:05 junk': None,
+            'not a time': None,
+            '': None,
+        }
+        for text, expected in cases.items():
+            self.assertEqual(parse_iso_to_dt(text), expected, text)
+        self.assertEqual(apache_to_text('01/Mar/2024:10:00:05'), '2024-03-01 10:00:05')
+
+    def test_watermark_follows_log_time(self):
+        wm = Watermark(allowed_lateness=10)
+        self.assertIsNone(wm.cutoff())
+        self.assertTrue(wm.observe(datetime(2024, 3, 1, 10, 1, 0)))
+        self.assertFalse(wm.observe(datetime(2024, 3, 1, 10, 0, 0)))  # late line does not move it back
+        self.assertTrue(wm.observe(parse_iso_to_dt('2024-03-01T11:02:00+01:00')))
+        self.assertEqual(wm.cutoff(), datetime(2024, 3, 1, 10, 1, 20))
+
+    def test_merge_buffer_expires_oldest_first(self):
+        buf = MergeBuffer()
+        stamps = {'a': '2024-03-01 10:00:10', 'b': '2024-03-01T09:59:00+01:00', 'c': '2024-03-01 10:00:05', 'd': 'n/a'}
+        for key, ts in stamps.items():
+            buf.put(key, CallBufferItem(key, '', '/old/endpoint01/', ts, parse_iso_to_dt(ts)))
+        # 'c' is seen again later, so its first heap entry goes stale
+        c = buf.get('c')
+        c.merge('2024-03-01 10:01:00', {}, parse_iso_to_dt('2024-03-01 10:01:00'))
+        buf.touch('c', c)
+        expired = buf.expire(datetime(2024, 3, 1, 10, 0, 30))
+        self.assertEqual([i.username for i in expired], ['b', 'a'])
+        self.assertEqual(sorted(i.username for i in buf.pop_all()), ['c', 'd'])
+
+    def test_tailed_file_follows_appends_rotation_and_truncation(self):
+        path = self.write_log('live.log', SAMPLE_LOG_LINES[:1])
+        tailed = TailedFile(path)
+        self.addCleanup(tailed.close)
+        self.assertEqual(tailed.read_lines(), [])  # starts at the end
+        with open(path, 'a') as fh:
+            fh.write(SAMPLE_LOG_LINES[1] + 'partial')
+        self.assertEqual(tailed.read_lines(), [SAMPLE_LOG_LINES[1]])
+        with open(path, 'a') as fh:
+            fh.write(' line\n')
+        self.assertEqual(tailed.read_lines(), ['partial line\n'])
+        os.rename(path, path + '.1')
+        self.write_log('live.log', SAMPLE_LOG_LINES[2:4])
+        self.assertEqual(tailed.read_lines(), SAMPLE_LOG_LINES[2:4])
+        with open(path, 'w') as fh:
+            fh.write(SAMPLE_LOG_LINES[4])
+        self.assertEqual(tailed.read_lines(), [SAMPLE_LOG_LINES[4]])
+
+    def run_process_files(self, paths, **kwargs):
+        db = os.path.join(self.tmpdir.name, 'out.db')
+        report = os.path.join(self.tmpdir.name, 'report.csv')
+        for leftover in (db, report):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+        process_files(paths, db, report, **kwargs)
+        conn = sqlite3.connect(db)
+        self.addCleanup(conn.close)
+        with open(report, newline='') as fh:
+            return conn, list(csv.reader(fh))
+
+    def db_rows(self, conn):
+        # (calls, parameters) of a processed DB, in id order
+        return (conn.execute("SELECT * FROM call ORDER BY ID;").fetchall(),
+                conn.execute("SELECT * FROM call_parameters ORDER BY id;").fetchall())
+
+    def assert_same_output(self, paths, base=None, **kwargs):
+        # process paths with the options in base, then with kwargs added: both runs must store the same calls and
+        # parameters (ids included) and write the same report. Returns the connection to the second run's DB.
+        base = base or {}
+        conn, report = self.run_process_files(paths, **base)
+        expected = self.db_rows(conn), report
+        conn, report = self.run_process_files(paths, **base, **kwargs)
+        self.assertEqual((self.db_rows(conn), report), expected)
+        return conn
+
+    def test_bulk_load_matches_default_path(self):
+        path = self.write_log('a.log', SAMPLE_LOG_LINES * 3)
+        conn = self.assert_same_output([path], bulk_load=True)
+        indexes = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index';")}
+        self.assertTrue(set(CREATE_INDEXES) <= indexes)
+
+    def test_normalized_schema_matches_plain_tables(self):
+        path = self.write_log('a.log', SAMPLE_LOG_LINES * 3)
+        for bulk_load in (False, True):
+            conn = self.assert_same_output([path], normalized_schema=True, bulk_load=bulk_load)
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM endpoint_dim;").fetchone(),
+                             conn.execute("SELECT COUNT(DISTINCT endpoint) FROM call;").fetchone())
+        # an existing DB keeps its layout
+        self.assertTrue(init_db(conn))
+        self.assertFalse(init_db(sqlite3.connect(':memory:')))
+
+    def test_writer_thread_matches_inline_writes(self):
+        path = self.write_log('a.log', SAMPLE_LOG_LINES * 3)
+        for base in ({}, {'bulk_load': True, 'incremental': True}):
+            self.assert_same_output([path], base, writer_thread=True)
+        # a failure on the writer thread comes back to the submitting thread
+        background = BackgroundWriter()
+        background.submit(operator.truediv, 1, 0)
+        with self.assertRaises(ZeroDivisionError):
+            background.close()
+
+    def test_merge_shards_match_single_buffer(self):
+        start = datetime(2024, 3, 1, 10, 0, 0)
+        lines = []
+        for i in range(400):
+            ts = start + timedelta(seconds=7 * i + i % 3 * 20)  # some lines are late, some gaps close calls
+            stamp = f"{ts:%Y-%m-%dT%H:%M:%S}+00:00" if i % 4 == 0 else f"{ts:%Y-%m-%d %H:%M:%S}"
+            lines.append(f'{stamp} 10.0.0.{i % 3} {{"user": "u{i % 5}"}} GET /new/endpoint0{i % 2}/SPY?p{i % 6} 200\n')
+        # the line moving the watermark past its own open call still merges into it; naive and offset-aware
+        # times are compared in UTC, so the second pair is 5 hours apart and two calls
+        lines += ['2024-03-01 12:00:00 10.0.0.9 {"user": "solo"} GET /new/endpoint07/ 200\n',
+                  '2024-03-01T12:00:20+00:00 10.0.0.9 {"user": "solo"} GET /new/endpoint07/ 200\n',
+                  '2024-03-01 12:02:00 10.0.0.9 {"user": "gap"} GET /new/endpoint07/ 200\n',
+                  '2024-03-01T17:02:00+00:00 10.0.0.9 {"user": "gap"} GET /new/endpoint07/ 200\n']
+        calls_sql = ("SELECT c.username, c.date_of_call, c.ip_address, c.endpoint, GROUP_CONCAT(p.parameter_name) "
+                     "FROM call c LEFT JOIN call_parameters p ON p.call_id = c.ID GROUP BY c.ID ORDER BY 1, 2, 3, 4, 5;")
+        for kwargs in ({}, {'incremental': True}):
+            results = []
+            for merge_shards in (1, 3):
+                path = self.write_log('a.log', lines[:250])
+                conn, report = self.run_process_files([path], merge_shards=merge_shards, **kwargs)
+                if kwargs:
+                    conn.close()
+                    with open(path, 'a') as fh:
+                        fh.writelines(lines[250:])
+                    process_files([path], os.path.join(self.tmpdir.name, 'out.db'),
+                                  os.path.join(self.tmpdir.name, 'report.csv'), merge_shards=merge_shards, **kwargs)
+                    conn = sqlite3.connect(os.path.join(self.tmpdir.name, 'out.db'))
+                    self.addCleanup(conn.close)
+                    with open(os.path.join(self.tmpdir.name, 'report.csv'), newline='') as fh:
+                        report = list(csv.reader(fh))
+                results.append((conn.execute(calls_sql).fetchall(), report))
+            self.assertEqual(results[0], results[1])
+            self.assertGreater(len(results[0][0]), 5)
+        # incremental run: the first 'gap' call is closed by the second, which is still open (in open_call)
+        self.assertEqual(Counter(row[0] for row in results[0][0] if row[0] in ('solo', 'gap')), {'solo': 1, 'gap': 1})
+
+    def test_dedup_skips_stored_calls(self):
+        path = self.write_log('a.log', SAMPLE_LOG_LINES[1:4] + SAMPLE_LOG_LINES[1:4])
+        replay = self.write_log('b.log', SAMPLE_LOG_LINES[1:4])
+        db = os.path.join(self.tmpdir.name, 'out.db')
+        report = os.path.join(self.tmpdir.name, 'report.csv')
+        for normalized_schema in (False, True):
+            conn, _ = self.run_process_files([replay], normalized_schema=normalized_schema)
+            calls, params = self.db_rows(conn)
+            # the repeat within a.log and the replayed b.log add nothing, whether fingerprinted while written
+            # or caught up from a run without --dedup
+            for first_dedup in (True, False):
+                conn, _ = self.run_process_files([path], normalized_schema=normalized_schema, dedup=first_dedup)
+                conn.close()
+                stats = process_files([replay], db, report, normalized_schema=normalized_schema, dedup=True)
+                self.assertEqual(stats.counters['duplicate_calls'], len(calls))
+                conn = sqlite3.connect(db)
+                self.addCleanup(conn.close)
+                if first_dedup:
+                    self.assertEqual(self.db_rows(conn), (calls, params))
+                self.assertEqual(conn.execute("SELECT COUNT(*) FROM call_fingerprint;").fetchone()[0], len(calls))
+        bloom = ScalableBloomFilter(100, 0.01)
+        for i in range(1000):
+            bloom.add(i * 7919)
+        self.assertTrue(all(i * 7919 in bloom for i in range(1000)))
+        self.assertGreater(len(bloom.filters), 1)
+        self.assertLess(sum(-i in bloom for i in range(1, 10001)), 100)
+        self.assertEqual(ScalableBloomFilter.from_bytes(bloom.to_bytes()).filters, bloom.filters)
+
+    def test_partitioned_tables_match_plain_tables(self):
+        start = datetime(2024, 3, 1, 10, 0, 0)
+        lines = [f'{start + timedelta(hours=9 * i):%Y-%m-%d %H:%M:%S} 10.0.0.{i % 3} {{"user": "u{i % 5}"}} '
+                 f'GET /new/endpoint0{i % 2}/SPY?p{i % 6} 200\n' for i in range(100)]  # about 37 days
+        # a timestamp that matches but does not parse goes to the undated partition
+        undated = '2024-02-30 10:00:00 10.0.0.7 {"user": "carol"} GET /new/endpoint02/SPY?p 200\n'
+        path = self.write_log('a.log', lines + SAMPLE_LOG_LINES + [undated])
+        for partition, bulk_load, n_partitions in (('day', False, 39), ('month', True, 3)):
+            conn = self.assert_same_output([path], partition=partition, bulk_load=bulk_load)
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM call_partition;").fetchone()[0], n_partitions)
+            indexes = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index';")}
+            self.assertIn('idx_call_epoch_p20240301' if partition == 'day' else 'idx_call_epoch_p202403', indexes)
+            self.assertEqual(conn.execute("SELECT username FROM call_undated;").fetchall(), [('carol',)])
+        # --retain-days drops whole partitions, and their dates from the rollups; month partitions are kept
+        # until their last day is old enough
+        calls = self.db_rows(conn)[0]
+        newest = date.fromisoformat(max(call[6] for call in calls if call[6] is not None))
+        for partition, first_kept in (('day', newest - timedelta(days=10)), ('month', date(2024, 3, 1))):
+            conn, _ = self.run_process_files([path], partition=partition, retain_days=10)
+            kept = [call for call in calls if call[6] is None or call[6] >= first_kept.isoformat()]
+            self.assertEqual(self.db_rows(conn)[0], kept)
+            self.assertEqual(conn.execute("SELECT SUM(number_of_calls) FROM call_daily_summary;").fetchone()[0], len(kept))
+            self.assertEqual(len(kept) < len(calls), partition == 'day')
+        # a far-future timestamp is not taken as the newest call
+        future = '2099-01-01 10:00:00 10.0.0.8 {"user": "dave"} GET /new/endpoint02/ 200\n'
+        conn, _ = self.run_process_files([self.write_log('b.log', lines + [future])], partition='day', retain_days=10)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM call;").fetchone()[0],
+                         sum(call[6] is not None and call[6] >= (newest - timedelta(days=10)).isoformat()
+                             for call in calls) + 1)
+        with self.assertRaises(ValueError):
+            init_db(sqlite3.connect(':memory:'), normalized=True, partition='day')
+
+    def test_stats_json(self):
+        path = self.write_log('a.log', SAMPLE_LOG_LINES * 3)
+        stats_path = os.path.join(self.tmpdir.name, 'stats.json')
+        for kwargs in ({}, {'workers': 2}, {'use_mmap': True}):
+            conn, _ = self.run_process_files([path], stats_json=stats_path, **kwargs)
+            with open(stats_path) as fh:
+                run_stats = json.load(fh)
+            self.assertEqual(run_stats['counters']['lines'], len(SAMPLE_LOG_LINES) * 3)
+            self.assertEqual(run_stats['counters']['bytes'], os.path.getsize(path))
+            self.assertEqual(run_stats['counters']['db_rows'], conn.execute("SELECT COUNT(*) FROM call;").fetchone()[0])
+            # this run's lookups only, made in the workers with --workers
+            self.assertEqual(run_stats['counters']['normalize_hits'] + run_stats['counters']['normalize_misses'], 12)
+            self.assertTrue({'match', 'extract', 'merge', 'db_insert', 'report'} <= set(run_stats['stage_seconds']))
+
+    def test_daily_summary_tracks_call_table(self):
+        path = self.write_log('a.log', SAMPLE_LOG_LINES * 3)
+        db = os.path.join(self.tmpdir.name, 'summary.db')
+        report = os.path.join(self.tmpdir.name, 'summary.csv')
+        process_files([path], db, report, incremental=True)
+        undated = '2024/02/30 10:00:00 10.0.0.3 {"user": "carol"} GET /new/endpoint02/ 200\n'
+        with open(path, 'a') as fh:
+            fh.writelines(SAMPLE_LOG_LINES[::-1] + [undated])
+        process_files([path], db, report, incremental=True)
+        conn = sqlite3.connect(db)
+        self.addCleanup(conn.close)
+        group_by = ("SELECT username, IFNULL(call_date, ''), endpoint, COUNT(*) FROM call "
+                    "GROUP BY 1, 2, 3 ORDER BY 1, 2, 3;")
+        summary = "SELECT * FROM call_daily_summary ORDER BY 1, 2, 3;"
+        self.assertEqual(conn.execute(summary).fetchall(), conn.execute(group_by).fetchall())
+        with open(report, newline='') as fh:
+            self.assertIn(['carol', '', '/new/endpoint02/', '1'], list(csv.reader(fh)))
+        # a DB from before the rollup gets it rebuilt from the call table
+        conn.execute("DROP TABLE call_daily_summary;")
+        init_db(conn)
+        self.assertEqual(conn.execute(summary).fetchall(), conn.execute(group_by).fetchall())
+
+    def test_failed_incremental_run_leaves_db_unchanged(self):
+        path = self.write_log('a.log', SAMPLE_LOG_LINES * 3)
+        dbs = [os.path.join(self.tmpdir.name, name) for name in ('clean.db', 'crashed.db')]
+        report = os.path.join(self.tmpdir.name, 'report.csv')
+        for db in dbs:
+            process_files([path], db, report, incremental=True)
+        with open(path, 'a') as fh:
+            fh.writelines(SAMPLE_LOG_LINES)
+        # dies after writing its calls, before the checkpoints are stored: nothing of it may be committed
+        with mock.patch.object(sys.modules[__name__], 'save_checkpoints', side_effect=RuntimeError('disk full')):
+            with self.assertRaises(RuntimeError):
+                process_files([path], dbs[1], report, incremental=True)
+        gc.collect()  # the failed run's connection (and its open transaction) goes away as with a dead process
+        results = []
+        for db in dbs:
+            process_files([path], db, report, incremental=True)
+            conn = sqlite3.connect(db)
+            self.addCleanup(conn.close)
+            results.append((self.db_rows(conn), conn.execute("SELECT * FROM open_call ORDER BY 1, 2, 3;").fetchall()))
+        self.assertEqual(results[1], results[0])
+
+    def test_incremental_compressed_rotation_reads_only_new_data(self):
+        lines = [f'2024-03-01 10:{i:02d}:00 user=u{i} 10.0.0.1 GET /new/endpoint01/\n' for i in range(11)]
+        path = self.write_log('app.log', lines[:10])
+        db = os.path.join(self.tmpdir.name, 'rotation.db')
+        report = os.path.join(self.tmpdir.name, 'rotation.csv')
+        process_files([path], db, report, incremental=True)
+        with open(path, 'a') as fh:
+            fh.write(lines[10])
+        # rotate, then compress the rotation: app.log -> app.log.1 -> app.log.1.gz, and a new empty app.log
+        os.rename(path, path + '.1')
+        with open(path + '.1', 'rb') as src, gzip.open(path + '.1.gz', 'wb') as dst:
+            dst.write(src.read())
+        os.remove(path + '.1')
+        self.write_log('app.log', [])
+        process_files([path + '.1.gz', path], db, report, incremental=True)
+        conn = sqlite3.connect(db)
+        self.addCleanup(conn.close)
+        count = "SELECT (SELECT COUNT(*) FROM call) + (SELECT COUNT(*) FROM open_call);"
+        self.assertEqual(conn.execute(count).fetchone()[0], 11)
+
+    def test_log_format_auto(self):
+        app_lines = [line for line in SAMPLE_LOG_LINES if line.startswith('2024-03-01 ')] * 3
+        path = self.write_log('app.log', app_lines + SAMPLE_LOG_LINES)
+        self.assertEqual(detect_log_format(path), 'app')
+        self.assertEqual(detect_log_format(self.write_log('mixed.log', SAMPLE_LOG_LINES[1:4])), 'heuristic')
+        heuristic = self.flatten(iter_record_chunks([path]))
+        stats = StageStats()
+        self.assertEqual(self.flatten(iter_record_chunks([path], log_format='auto', stats=stats)), heuristic)
+        self.assertEqual(stats.counters['format_fallback'], 1)  # the nginx line
+        self.assertEqual(self.flatten(iter_record_chunks([path], workers=2, shard_size=200, use_mmap=True,
+                                                         log_format='app')), heuristic)
+
+    def test_query_matches_call_table(self):
+        path = self.write_log('a.log', SAMPLE_LOG_LINES * 2)
+        db = os.path.join(self.tmpdir.name, 'query.db')
+        process_files([path], db, os.path.join(self.tmpdir.name, 'query.csv'))
+        conn = sqlite3.connect(db)
+        self.addCleanup(conn.close)
+        raw = lambda sql: conn.execute(sql).fetchall()
+        self.assertEqual(query_calls(conn, 'top-endpoints')[1],
+                         raw("SELECT endpoint, COUNT(*) FROM call GROUP BY 1 ORDER BY 2 DESC, 1 LIMIT 10;"))
+        self.assertEqual(query_calls(conn, 'tickers')[1],
+                         raw("SELECT parameter_value, COUNT(*) FROM call_parameters WHERE parameter_name = 'ticker' "
+                             "GROUP BY 1 ORDER BY 2 DESC, 1;"))
+        hourly = raw("SELECT strftime('%Y-%m-%d %H:00', call_epoch, 'unixepoch'), COUNT(*) FROM call "
+                     "WHERE call_epoch IS NOT NULL GROUP BY 1 ORDER BY 1;")
+        self.assertEqual(query_calls(conn, 'histogram', bucket='hour')[1], hourly)
+        self.assertEqual(sum(n for _, n in query_calls(conn, 'histogram', bucket='minute')[1]),
+                         sum(n for _, n in hourly))
+        user, = raw("SELECT username FROM call LIMIT 1;")[0]
+        self.assertEqual(query_calls(conn, 'users', username=user)[1],
+                         raw(f"SELECT username, COUNT(*) FROM call WHERE username = '{user}' GROUP BY 1;"))
+        with self.assertRaises(ValueError):
+            query_calls(conn, 'tickers', username=user)
+        # the 'query' subcommand only reads
+        with mock.patch.object(sys, 'stdout', io.StringIO()) as out:
+            query_main(['users', '--db', db])
+        self.assertEqual(list(csv.reader(io.StringIO(out.getvalue())))[1:],
+                         [[u, str(n)] for u, n in query_calls(conn, 'users')[1]])
+        conn.execute("DROP TABLE call_hourly_summary;")
+        conn.commit()
+        with mock.patch.object(sys, 'stderr', io.StringIO()), self.assertRaises(SystemExit):
+            query_main(['users', '--db', db])
+        self.assertIsNone(conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'call_hourly_summary';").fetchone())
+
+    def test_call_writers_share_database(self):
+        db = os.path.join(self.tmpdir.name, 'shared.db')
+        conns = [sqlite3.connect(db), sqlite3.connect(db)]
+        for conn in conns:
+            self.addCleanup(conn.close)
+            init_db(conn)
+        writers = [CallWriter(conn) for conn in conns]
+
+        def batch(tag):
+            calls = [('alice', '2024-03-01 10:00:00', '10.0.0.1', f'/new/{tag}{i}/') + call_time_columns('2024-03-01 10:00:00')
+                     for i in range(3)]
+            return calls, [(i, 'tag', f'{tag}{i}') for i in range(3)]
+
+        writers[0].write(*batch('a'))
+        writers[1].write(*batch('b'))
+        conns[0].execute("INSERT INTO call (username, endpoint) VALUES ('bob', '/old/manual/');")  # no reservation
+        conns[0].commit()
+        writers[0].write(*batch('c'))
+        conns[1].rollback()
+        reserve_ids(conns[1].cursor(), 'call', 100)
+        conns[1].rollback()  # the reserved range is given back
+        writers[1].write(*batch('d'))
+        ids = [r[0] for r in conns[0].execute("SELECT ID FROM call ORDER BY ID;")]
+        self.assertEqual(ids, list(range(1, 14)))
+        joined = conns[0].execute("SELECT c.endpoint, p.parameter_value FROM call_parameters p "
+                                  "JOIN call c ON c.ID = p.call_id;").fetchall()
+        self.assertEqual(len(joined), 12)
+        self.assertTrue(all(endpoint == f'/new/{value}/' for endpoint, value in joined))
+
+    def test_columnar_partition(self):
+        self.assertEqual(columnar_partition('2024-03-01', '/new/endpoint05/top/'),
+                         os.path.join('date=2024-03-01', 'endpoint=%2Fnew%2Fendpoint05%2Ftop%2F'))
+        # a call whose timestamp did not parse has no call_date
+        self.assertEqual(call_time_columns('2024/02/30 10:00:00'), (None, None))
+        self.assertEqual(columnar_partition(None, '/old/endpoint01/'),
+                         os.path.join('date=__HIVE_DEFAULT_PARTITION__', 'endpoint=%2Fold%2Fendpoint01%2F'))
+
+    @unittest.skipIf(pa is None, "pyarrow not installed")
+    def test_columnar_sink_matches_db(self):
+        import pyarrow.dataset as ds
+        path = self.write_log('a.log', SAMPLE_LOG_LINES * 3)
+        out_dir = os.path.join(self.tmpdir.name, 'columnar')
+        conn, _ = self.run_process_files([path], columnar_dir=out_dir)
+        calls = ds.dataset(os.path.join(out_dir, 'call'), partitioning='hive').to_table().to_pylist()
+        got = sorted((r['call_id'], r['username'], r['date_of_call'], r['ip_address'], r['endpoint'], r['call_epoch'],
+                      r['date']) for r in calls)
+        self.assertEqual(got, conn.execute("SELECT * FROM call ORDER BY ID;").fetchall())
+        params = ds.dataset(os.path.join(out_dir, 'call_parameters'), partitioning='hive').to_table().to_pylist()
+        got = sorted((r['call_id'], r['parameter_name'], r['parameter_value']) for r in params)
+        self.assertEqual(got, sorted(conn.execute("SELECT call_id, parameter_name, parameter_value FROM call_parameters;")))
+
+    def test_parallel_records_match_serial(self):
+        a = self.write_log('a.log', SAMPLE_LOG_LINES * 50)
+        b = self.write_log('b.log', SAMPLE_LOG_LINES[::-1] * 30)
+        serial = self.flatten(iter_record_chunks([a, b]))
+        parallel = self.flatten(iter_record_chunks([a, b], workers=2, shard_size=256))
+        self.assertEqual(serial[0], len(SAMPLE_LOG_LINES) * 80)
+        self.assertEqual(serial, parallel)
+
 # ---------------------------
 # CLI
 # ---------------------------
 def main():
+    if sys.argv[1:2] == ['query']:
+        return query_main(sys.argv[2:])
     parser = argparse.ArgumentParser(description="Process large log files to extract calls to /old|/new endpointXX")
     parser.add_argument('paths', nargs='*', help='files or directories to process')
     parser.add_argument('--db', default='processed_calls.db', help='sqlite db path')
     parser.add_argument('--report', default='calls_report.csv', help='output CSV report path')
+    parser.add_argument('--format', choices=FORMAT_CHOICES, default='heuristic', dest='log_format',
+                        help="log layout: parse fixed fields of a known format, detect one per file ('auto'), "
+                             "or search every line with the heuristics")
+    parser.add_argument('--workers', type=int, default=1, help='extract with N worker processes (files are split into byte-range shards)')
+    parser.add_argument('--mmap', action='store_true', help='memory-map inputs and scan raw bytes, decoding only matching lines')
+    parser.add_argument('--decompress-thread', action='store_true', help='decompress .gz/.bz2/.xz/.zst inputs on a read-ahead thread')
+    parser.add_argument('--incremental', action='store_true', help='resume from per-file checkpoints in the DB and only process new data')
+    parser.add_argument('--follow', action='store_true', help='keep tailing the input files (like tail -F) until interrupted')
+    parser.add_argument('--commit-interval', type=float, default=FOLLOW_COMMIT_SECONDS, help='--follow: seconds between micro-batch commits')
+    parser.add_argument('--allowed-lateness', type=float, default=ALLOWED_LATENESS_SECONDS,
+                        help='seconds a line may lag the newest log timestamp and still merge into an open call')
+    parser.add_argument('--bulk-load', action='store_true',
+                        help='tune SQLite for ingestion: WAL, synchronous=OFF, large transactions, indexes rebuilt at the end')
+    parser.add_argument('--normalized-schema', action='store_true',
+                        help='new DB: store endpoints, users and parameter names once in lookup tables, referenced by id')
+    parser.add_argument('--partition', choices=list(PARTITION_GRANULARITIES),
+                        help='new DB: keep the calls in one table per UTC day or month, behind call / call_parameters views')
+    parser.add_argument('--retain-days', type=int,
+                        help='--partition DB: drop the partitions older than N days before the newest call')
+    parser.add_argument('--merge-shards', type=int, default=1,
+                        help='merge multi-line calls in N processes, each owning the calls of a hash range of keys')
+    parser.add_argument('--dedup', action='store_true',
+                        help='skip calls identical to one already in the DB (replayed or overlapping logs)')
+    parser.add_argument('--writer-thread', action='store_true',
+                        help='write to SQLite on a dedicated thread fed by a bounded queue, overlapping parsing')
+    parser.add_argument('--progress-interval', type=float, default=PROGRESS_SECONDS,
+                        help='seconds between progress lines on stderr (0 to turn them off)')
+    parser.add_argument('--stats-json', help='write per-stage timings and counters to this JSON file')
+    parser.add_argument('--columnar-dir', help='also write calls and parameters as partitioned columnar files here (needs pyarrow)')
+    parser.add_argument('--columnar-format', choices=['parquet', 'arrow'], default='parquet',
+                        help='--columnar-dir file format: Parquet or Arrow IPC')
     parser.add_argument('--run-tests', action='store_true', help='run unit tests and exit')
     args = parser.parse_args()
+    if args.partition and args.normalized_schema:
+        parser.error("--partition cannot be combined with --normalized-schema")
+    if args.retain_days is not None:
+        if args.retain_days < 0:
+            parser.error("--retain-days cannot be negative")
+        # checked before the DB is created: an existing DB keeps its layout, a new one gets --partition's
+        partition = args.partition
+        if os.path.exists(args.db):
+            conn = connect_read_only(args.db)
+            partition = partition_granularity(conn.cursor())
+            conn.close()
+        if partition is None:
+            parser.error("--retain-days needs --partition (or a DB created with it)")
     if args.run_tests:
-        suite = unittest.defaultTestLoader.loadTestsFromTestCase(TestParsingLogic)
+        suite = unittest.TestSuite(unittest.defaultTestLoader.loadTestsFromTestCase(case)
+                                   for case in (TestParsingLogic, TestProcessFiles))
         runner = unittest.TextTestRunner()
         res = runner.run(suite)
         sys.exit(0 if res.wasSuccessful() else 2)
@@ -501,7 +3383,14 @@ def main():
         parser.print_help()
         sys.exit(1)
     start = time.time()
-    process_files(args.paths, args.db, args.report)
+    process_files(args.paths, args.db, args.report, workers=args.workers, use_mmap=args.mmap,
+                  readahead=args.decompress_thread, incremental=args.incremental,
+                  follow=args.follow, commit_interval=args.commit_interval, allowed_lateness=args.allowed_lateness,
+                  bulk_load=args.bulk_load, columnar_dir=args.columnar_dir, columnar_format=args.columnar_format,
+                  normalized_schema=args.normalized_schema, progress_interval=args.progress_interval,
+                  stats_json=args.stats_json, writer_thread=args.writer_thread, log_format=args.log_format,
+                  merge_shards=args.merge_shards, dedup=args.dedup, partition=args.partition,
+                  retain_days=args.retain_days)
     end = time.time()
     print(f"Total time: {end-start:.2f} seconds")
 
@@ -0,0 +1,465 @@
+#!/usr/bin/env python3
+"""
+bench_log_processor.py
+
+Benchmarks for Activity_TDD.py on generated logs.
+
+Usage:
+  python bench_log_processor.py scanner                      # 10M generated lines
+  python bench_log_processor.py scanner --lines 1000000 --keep /tmp/bench.log
+  python bench_log_processor.py scanner --log /path/to/existing.log
+  python bench_log_processor.py memory --lines 50000000
+  python bench_log_processor.py dbload --rows 2000000
+  python bench_log_processor.py generate --size-mb 4096 --keep /data/bench-4g.log
+  python bench_log_processor.py suite --log /data/bench-4g.log --results-json base.json
+  python bench_log_processor.py suite --log /data/bench-4g.log --baseline base.json --configs serial,mmap
+  python bench_log_processor.py suite --size-mb 512 --layout nginx --configs serial,auto-format
+
+Benchmarks:
+ - scanner: lines/sec of the per-line extraction. 'before' is the original cascade (RE_ENDPOINT, then
+   find_username, find_first_ip, parse_timestamp); 'after' is extract_call's line scanning (the '/old/' /
+   '/new/' substring prefilter, then scan_fields). Both call the uncached normalize_endpoint_and_params, so
+   the normalize_cached gain (measured by 'suite') is not counted here.
+ - memory: peak RSS of the merge stage holding every call of the log open, then building the insert batch
+   for all of them (the worst case for the merge buffer). 'before' uses a plain __dict__ item class with the
+   strings exactly as extracted; 'after' uses CallBufferItem (__slots__) and intern_call_fields. Each side
+   runs in its own subprocess so the peaks do not mix. Peak RSS needs the 'resource' module (not on Windows).
+ - dbload: call rows/sec through CallWriter into a fresh SQLite file. 'before' is the default path (indexes
+   in place, default journal, one commit per DB_BATCH_SIZE batch); 'after' is --bulk-load, including the
+   index rebuild and ANALYZE at the end. No log is needed.
+ - suite: the whole process_files pipeline per configuration (SUITE_CONFIGS: serial, workers, mmap,
+   bulk-load, normalized schema, --format auto, --merge-shards, --dedup, --partition), each run in its own subprocess: lines/sec, MB/sec, peak RSS (workers
+   included) and DB size. --results-json saves them; --baseline compares with a saved file and exits with
+   status 1 if any metric is worse by more than --tolerance.
+
+Generated logs (generate_log) are deterministic per --seed: Zipf-skewed users and endpoints (--skew), the
+nginx / JSON / key=value layouts with every supported timestamp format, tickers and query strings, calls
+split over several lines (--split-ratio) and slightly late timestamps. --layout nginx|jsonl|app writes every
+line (calls and the other traffic) in that one layout instead, as a --format profile expects; 'auto-format'
+against 'serial' on such a log measures the profile fast path. 'generate' only writes the log.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import Activity_TDD as activity
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# ---------------------------
+# Log generation
+# ---------------------------
+USERS = ['alice', 'bob@example.com', 'carol', 'dave.smith', 'eve@corp.example.org']
+ENDPOINTS = [
+    '/new/endpoint05/ARKK/top?date=current',
+    '/new/endpoint09/CFO?date=current',
+    '/new/endpoint10/',
+    '/old/endpoint01/',
+    '/old/endpoint12/list?page=2&sort',
+]
+TICKERS = ['ARKK', 'CFO', 'SPY', 'QQQ', 'TSLA', 'AAPL', 'MSFT', 'IWM', 'XLF', 'GLD']
+SUFFIXES = ['', '', 'top', 'list', 'history']
+QUERIES = ['', '', '?date=current', '?page=2&sort', '?date=2024-03-01&limit=50', '?verbose']
+
+def zipf_cum_weights(n, skew):
+    # cumulative weights for random.choices: item i is drawn with weight 1 / (i + 1) ** skew (0 = uniform)
+    return list(itertools.accumulate(1 / (i + 1) ** skew for i in range(n)))
+
+def timestamp_formats():
+    # the timestamp layouts parse_timestamp understands (the Apache one is written by the nginx layout)
+    return [
+        lambda t: f"{t:%Y-%m-%dT%H:%M:%S}",
+        lambda t: f"{t:%Y-%m-%dT%H:%M:%S}.{t.microsecond // 1000:03d}Z",
+        lambda t: f"{t:%Y-%m-%dT%H:%M:%S}+00:00",
+        lambda t: f"{t:%Y-%m-%d %H:%M:%S}",
+        lambda t: f"{t:%Y/%m/%d %H:%M:%S}",
+    ]
+
+LAYOUTS = ['mixed', 'nginx', 'jsonl', 'app']
+
+def layout_line(layout, ts_time, ip, user, path_part):
+    # one request line in a single-format layout (the --format profiles of Activity_TDD.py)
+    if layout == 'nginx':
+        return f'{ip} - {user} [{ts_time:%d/%b/%Y:%H:%M:%S} +0000] "GET {path_part} HTTP/1.1" 200 512 "-" "curl/8.0"\n'
+    if layout == 'jsonl':
+        return json.dumps({'time': f"{ts_time:%Y-%m-%dT%H:%M:%S}.{ts_time.microsecond // 1000:03d}Z",
+                           'remote_addr': ip, 'user': user, 'request': f"GET {path_part} HTTP/1.1",
+                           'status': 200}) + '\n'
+    return f'{ts_time:%Y-%m-%d %H:%M:%S} {ip} {{"user": "{user}", "method": "GET"}} GET {path_part} 200\n'
+
+def generate_log(path, n_lines, seed=0, match_ratio=0.05, n_users=1000, n_endpoints=30, skew=1.1,
+                 split_ratio=0.2, late_ratio=0.02, layout='mixed'):
+    """
+    Write n_lines of mixed-format log to path; about match_ratio of them are endpoint calls.
+     - users (some of them emails) and endpoints are drawn with a Zipf skew (skew=0 is uniform); each user
+       calls from one to three fixed IPs
+     - endpoints are /old or /new endpointNN, with an optional ticker segment, suffix and query string
+     - calls use the nginx combined (Apache timestamp), JSON and key=value layouts and every supported
+       timestamp format
+     - split_ratio of the calls continue on one or two more lines a few seconds later (same user, ip and
+       endpoint, more parameters), which the merge stage has to put back together
+     - late_ratio of the lines carry a timestamp a few seconds behind the log clock
+     - layout other than 'mixed' writes all lines, calls and static-file requests, with layout_line
+    Deterministic for a given seed.
+    """
+    rnd = random.Random(seed)
+    users = [f"user{i:04d}@example.com" if i % 7 == 0 else f"user{i:04d}" for i in range(n_users)]
+    user_ips = [[f"10.{rnd.randint(0, 255)}.{rnd.randint(0, 255)}.{rnd.randint(1, 254)}"
+                 for _ in range(rnd.randint(1, 3))] for _ in range(n_users)]
+    endpoints = [f"/{rnd.choice(('old', 'new'))}/endpoint{i:02d}/" for i in range(1, n_endpoints + 1)]
+    user_weights = zipf_cum_weights(n_users, skew)
+    endpoint_weights = zipf_cum_weights(n_endpoints, skew)
+    formats = timestamp_formats()
+    t = datetime(2024, 3, 1)
+    pending = []  # (due line, user index, ip, path without query) for continuation lines of split calls
+    out = []
+    with open(path, 'w') as fh:
+        for i in range(n_lines):
+            if len(out) >= 10000:
+                fh.writelines(out)
+                out = []
+            t += timedelta(milliseconds=rnd.choice((0, 0, 50, 400, 1000)))
+            ts_time = t - timedelta(seconds=rnd.randint(1, 5)) if rnd.random() < late_ratio else t
+            if pending and pending[0][0] <= i:
+                _, u, ip, base = pending.pop(0)
+                path_part = base + rnd.choice(QUERIES[2:])
+            elif rnd.random() < match_ratio:
+                u = rnd.choices(range(n_users), cum_weights=user_weights)[0]
+                ip = rnd.choice(user_ips[u])
+                base = rnd.choices(endpoints, cum_weights=endpoint_weights)[0]
+                if rnd.random() < 0.4:
+                    base += rnd.choice(TICKERS) + '/'
+                base += rnd.choice(SUFFIXES)
+                path_part = base + rnd.choice(QUERIES)
+                if rnd.random() < split_ratio:
+                    for k in range(rnd.randint(1, 2)):
+                        pending.append((i + rnd.randint(1, 40) + k, u, ip, base))
+                    pending.sort()
+            elif layout != 'mixed':
+                out.append(layout_line(layout, ts_time, f"10.1.{i % 250}.{i % 200 + 1}", '-',
+                                       f"/static/app.{i % 9}.js"))
+                continue
+            else:
+                out.append(f"{formats[i % len(formats)](ts_time)} INFO worker-{i % 16} request handled in "
+                           f"{rnd.randint(1, 900)}ms path=/static/app.{i % 9}.js\n")
+                continue
+            user = users[u]
+            if layout != 'mixed':
+                out.append(layout_line(layout, ts_time, ip, user, path_part))
+                continue
+            fmt = rnd.randint(0, 2)
+            if fmt == 0:
+                out.append(f'{ip} - - [{ts_time:%d/%b/%Y:%H:%M:%S} +0000] "GET {path_part} HTTP/1.1" 200 '
+                           f'{rnd.randint(200, 9000)} "-" "curl/8.0" user={user}\n')
+            elif fmt == 1:
+                out.append(f'{rnd.choice(formats)(ts_time)} {ip} {{"user": "{user}", "method": "GET"}} '
+                           f'GET {path_part} 200\n')
+            else:
+                out.append(f'{rnd.choice(formats)(ts_time)} client={ip} usr={user} path={path_part}\n')
+        fh.writelines(out)
+
+def generate_log_of_size(path, size_mb, seed=0, **kwargs):
+    # generate_log sized in MB instead of lines (from the average line length of a small sample)
+    sample = path + '.sample'
+    generate_log(sample, 20000, seed=seed, **kwargs)
+    n_lines = int(size_mb * 1024 * 1024 * 20000 / os.path.getsize(sample))
+    os.unlink(sample)
+    generate_log(path, n_lines, seed=seed, **kwargs)
+    return n_lines
+
+# ---------------------------
+# Benchmarks
+# ---------------------------
+def extract_call_cascade(line):
+    # the original per-line cascade, kept here as the 'before' side of the scanner benchmark
+    m = activity.RE_ENDPOINT.search(line)
+    if not m:
+        return None
+    endpoint, params = activity.normalize_endpoint_and_params(m.group(0))
+    return (endpoint, params, activity.find_username(line) or 'unknown',
+            activity.find_first_ip(line) or '', activity.parse_timestamp(line))
+
+def extract_call_scan(line):
+    # extract_call without normalize_cached, as the 'after' side of the scanner benchmark
+    if '/old/' not in line and '/new/' not in line:
+        return None
+    m = activity.RE_ENDPOINT.search(line)
+    if not m:
+        return None
+    endpoint, params = activity.normalize_endpoint_and_params(m.group(0))
+    username, ip, timestamp_text = activity.scan_fields(line)
+    return endpoint, params, username or 'unknown', ip or '', timestamp_text
+
+def time_extraction(path, extract):
+    start = time.perf_counter()
+    lines = matched = 0
+    with open(path, 'r', errors='ignore') as fh:
+        for line in fh:
+            lines += 1
+            if extract(line) is not None:
+                matched += 1
+    return lines, matched, time.perf_counter() - start
+
+def bench_scanner(path):
+    results = {}
+    for name, extract in (('before', extract_call_cascade), ('after', extract_call_scan)):
+        lines, matched, elapsed = time_extraction(path, extract)
+        results[name] = lines / elapsed
+        print(f"{name:>6}: {lines} lines ({matched} calls) in {elapsed:.2f}s -> {lines / elapsed:,.0f} lines/sec")
+    print(f"speedup: {results['after'] / results['before']:.2f}x")
+
+class LegacyCallBufferItem:
+    # the merge buffer item as it was before __slots__ / interning, for the 'before' side of 'memory'
+    def __init__(self, username, ip, endpoint, timestamp_text):
+        self.username = username
+        self.ip = ip
+        self.endpoint = endpoint
+        self.params = {}
+        self.first_seen = timestamp_text
+        self.last_seen = timestamp_text
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # ru_maxrss is in KiB on Linux
+
+def measure_buffer(path, impl):
+    # one side of the 'memory' benchmark; runs in a subprocess
+    buffer = {}
+    with open(path, 'r', errors='ignore') as fh:
+        for line in fh:
+            found = activity.extract_call(line)
+            if not found:
+                continue
+            endpoint, params, username, ip, timestamp_text = found
+            if impl == 'after':
+                endpoint, params, username, ip = activity.intern_call_fields(endpoint, params, username, ip)
+                item = activity.CallBufferItem(username, ip, endpoint, timestamp_text,
+                                               activity.parse_iso_to_dt(timestamp_text))
+            else:
+                item = LegacyCallBufferItem(username, ip, endpoint, timestamp_text)
+            item.params.update(params)
+            buffer[(username, ip, endpoint, len(buffer))] = item  # every line is its own open call
+    calls, call_params = [], []
+    for item in buffer.values():
+        calls.append((item.username, item.first_seen, item.ip, item.endpoint))
+        for name, value in item.params.items():
+            call_params.append((len(calls) - 1, name, value))
+    return {'calls': len(calls), 'params': len(call_params), 'peak_rss_mb': peak_rss_mb()}
+
+def bench_memory(path):
+    results = {}
+    for impl in ('before', 'after'):
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), 'memory', '--log', path, '--impl', impl],
+                             check=True, capture_output=True, text=True).stdout
+        results[impl] = json.loads(out)
+        r = results[impl]
+        rss = 'n/a' if r['peak_rss_mb'] is None else f"{r['peak_rss_mb']:,.0f} MB"
+        print(f"{impl:>6}: {r['calls']} open calls, {r['params']} params -> peak RSS {rss}")
+    if results['before']['peak_rss_mb'] and results['after']['peak_rss_mb']:
+        print(f"peak RSS ratio: {results['after']['peak_rss_mb'] / results['before']['peak_rss_mb']:.2f}")
+
+def generate_call_batches(n_rows, seed=0):
+    # synthetic (calls, params) batches shaped like process_files queues them (params index into calls)
+    rnd = random.Random(seed)
+    t = datetime(2024, 3, 1)
+    batches = []
+    for start in range(0, n_rows, activity.DB_BATCH_SIZE):
+        calls, params = [], []
+        for idx in range(min(activity.DB_BATCH_SIZE, n_rows - start)):
+            t += timedelta(seconds=rnd.choice((0, 1, 2)))
+            endpoint, query = activity.normalize_endpoint_and_params(rnd.choice(ENDPOINTS))
+            ip = f"10.0.{rnd.randint(0, 255)}.{rnd.randint(1, 254)}"
+            date_of_call = f"{t:%Y-%m-%d %H:%M:%S}"
+            calls.append((rnd.choice(USERS), date_of_call, ip, endpoint) + activity.call_time_columns(date_of_call))
+            params.extend((idx, name, value) for name, value in query.items())
+        batches.append((calls, params))
+    return batches
+
+def bench_dbload(n_rows):
+    batches = generate_call_batches(n_rows)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name, bulk_load in (('before', False), ('after', True)):
+            conn = sqlite3.connect(os.path.join(tmpdir, f'{name}.db'))
+            activity.init_db(conn, create_indexes=not bulk_load)
+            start = time.perf_counter()
+            writer = activity.CallWriter(conn, bulk_load)
+            for calls, params in batches:
+                writer.write(calls, params)
+            writer.finish()
+            elapsed = time.perf_counter() - start
+            conn.close()
+            results[name] = n_rows / elapsed
+            print(f"{name:>6}: {n_rows} calls in {elapsed:.2f}s -> {n_rows / elapsed:,.0f} rows/sec")
+    print(f"speedup: {results['after'] / results['before']:.2f}x")
+
+# process_files configurations for 'suite': name -> keyword arguments
+SUITE_CONFIGS = {
+    'serial': {},
+    'workers4': {'workers': 4},
+    'mmap': {'use_mmap': True},
+    'mmap-workers4': {'use_mmap': True, 'workers': 4},
+    'bulk-load': {'bulk_load': True},
+    'normalized': {'normalized_schema': True},
+    'auto-format': {'log_format': 'auto'},
+    'workers4-shards4': {'workers': 4, 'merge_shards': 4},
+    'dedup': {'dedup': True},
+    'partition-day': {'partition': 'day'},
+}
+SUITE_METRICS = {  # metric -> True if higher is better (a drop beyond the tolerance is a regression)
+    'lines_per_sec': True,
+    'peak_rss_mb': False,
+    'db_size_mb': False,
+}
+
+def run_suite_config(path, name):
+    # one 'suite' run; runs in a subprocess so the peak RSS is this configuration's own
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = os.path.join(tmpdir, 'calls.db')
+        stats_json = os.path.join(tmpdir, 'stats.json')
+        with open(os.devnull, 'w') as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                activity.process_files([path], db, os.path.join(tmpdir, 'report.csv'), stats_json=stats_json,
+                                       progress_interval=0, **SUITE_CONFIGS[name])
+            finally:
+                sys.stdout = stdout
+        with open(stats_json) as fh:
+            run_stats = json.load(fh)
+        db_bytes = sum(os.path.getsize(db + suffix) for suffix in ('', '-wal') if os.path.exists(db + suffix))
+    peak = peak_rss_mb()
+    if peak is not None:
+        # worker processes have exited by now; count the largest of them too
+        peak = max(peak, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024)
+    return {
+        'lines_per_sec': run_stats['lines_per_sec'],
+        'mb_per_sec': run_stats['mb_per_sec'],
+        'elapsed_seconds': run_stats['elapsed_seconds'],
+        'stage_seconds': run_stats['stage_seconds'],
+        'peak_rss_mb': peak,
+        'db_size_mb': round(db_bytes / 1e6, 3),
+    }
+
+def bench_suite(path, configs, repeat=1, results_json=None, baseline=None, tolerance=0.1):
+    """
+    Run process_files on path once per configuration (best of `repeat` runs by lines/sec) and print
+    lines/sec, MB/sec, peak RSS and DB size. results_json saves the results; baseline compares them with a
+    saved results file and returns the regressions (metrics worse than the baseline by more than tolerance).
+    """
+    results = {'log': os.path.abspath(path), 'log_size_mb': round(os.path.getsize(path) / 1e6, 3), 'configs': {}}
+    print(f"{'config':<16}{'lines/sec':>14}{'MB/sec':>10}{'peak RSS MB':>14}{'DB MB':>10}")
+    for name in configs:
+        runs = []
+        for _ in range(repeat):
+            out = subprocess.run([sys.executable, os.path.abspath(__file__), 'suite', '--log', path,
+                                  '--suite-config', name], check=True, capture_output=True, text=True).stdout
+            runs.append(json.loads(out))
+        r = results['configs'][name] = max(runs, key=lambda run: run['lines_per_sec'])
+        rss = 'n/a' if r['peak_rss_mb'] is None else f"{r['peak_rss_mb']:,.0f}"
+        print(f"{name:<16}{r['lines_per_sec']:>14,.0f}{r['mb_per_sec']:>10.1f}{rss:>14}{r['db_size_mb']:>10.1f}")
+    if results_json:
+        with open(results_json, 'w') as fh:
+            json.dump(results, fh, indent=2)
+    regressions = []
+    if baseline:
+        with open(baseline) as fh:
+            base = json.load(fh)['configs']
+        for name, r in results['configs'].items():
+            for metric, higher_is_better in SUITE_METRICS.items():
+                old, new = base.get(name, {}).get(metric), r[metric]
+                if not old or new is None:
+                    continue
+                change = (new - old) / old
+                if (-change if higher_is_better else change) > tolerance:
+                    regressions.append(f"{name} {metric}: {old:,.1f} -> {new:,.1f} ({change:+.1%})")
+        print("\n".join(["regressions against the baseline:"] + regressions) if regressions
+              else f"no regressions against the baseline (tolerance {tolerance:.0%})")
+    return regressions
+
+# ---------------------------
+# CLI
+# ---------------------------
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for Activity_TDD.py")
+    parser.add_argument('benchmark', choices=['generate', 'scanner', 'memory', 'dbload', 'suite'], help='benchmark to run')
+    parser.add_argument('--log', help='existing log file to use instead of generating one')
+    parser.add_argument('--lines', type=int, default=10_000_000, help='lines to generate')
+    parser.add_argument('--size-mb', type=float, help='generate about this many MB instead of --lines')
+    parser.add_argument('--seed', type=int, default=0, help='generator seed')
+    parser.add_argument('--match-ratio', type=float, default=0.05, help='share of generated lines that are calls')
+    parser.add_argument('--skew', type=float, default=1.1, help='Zipf skew of users and endpoints (0 = uniform)')
+    parser.add_argument('--split-ratio', type=float, default=0.2, help='share of calls split over several lines')
+    parser.add_argument('--layout', choices=LAYOUTS, default='mixed', help='line layout of the generated log')
+    parser.add_argument('--keep', help='write the generated log here and keep it')
+    parser.add_argument('--rows', type=int, default=2_000_000, help='dbload: call rows to insert')
+    parser.add_argument('--configs', default=','.join(SUITE_CONFIGS),
+                        help=f"suite: comma-separated configurations ({', '.join(SUITE_CONFIGS)})")
+    parser.add_argument('--repeat', type=int, default=1, help='suite: runs per configuration (the best one counts)')
+    parser.add_argument('--results-json', help='suite: save the results here')
+    parser.add_argument('--baseline', help='suite: results JSON to compare with; exit status 1 on a regression')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='suite: allowed relative change (0.1 = 10%%)')
+    parser.add_argument('--impl', choices=['before', 'after'], help=argparse.SUPPRESS)  # 'memory' child process
+    parser.add_argument('--suite-config', choices=list(SUITE_CONFIGS), help=argparse.SUPPRESS)  # 'suite' child
+    args = parser.parse_args()
+
+    if args.impl:
+        print(json.dumps(measure_buffer(args.log, args.impl)))
+        return
+    if args.suite_config:
+        print(json.dumps(run_suite_config(args.log, args.suite_config)))
+        return
+    if args.benchmark == 'dbload':
+        bench_dbload(args.rows)
+        return
+    if args.benchmark == 'generate':
+        if not args.keep:
+            parser.error("generate needs --keep PATH")
+    configs = [c for c in args.configs.split(',') if c]
+    unknown = set(configs) - set(SUITE_CONFIGS)
+    if unknown:
+        parser.error(f"unknown suite configurations: {', '.join(sorted(unknown))}")
+    generator_options = {'match_ratio': args.match_ratio, 'skew': args.skew, 'split_ratio': args.split_ratio,
+                         'layout': args.layout}
+
+    path = args.log
+    tmp = None
+    if path is None:
+        if args.keep:
+            path = args.keep
+        else:
+            tmp = tempfile.NamedTemporaryFile(suffix='.log', delete=False)
+            tmp.close()
+            path = tmp.name
+        if args.size_mb:
+            print(f"Generating about {args.size_mb:g} MB into {path} ...", file=sys.stderr)
+            generate_log_of_size(path, args.size_mb, seed=args.seed, **generator_options)
+        else:
+            print(f"Generating {args.lines} lines into {path} ...", file=sys.stderr)
+            generate_log(path, args.lines, seed=args.seed, **generator_options)
+    try:
+        if args.benchmark == 'scanner':
+            bench_scanner(path)
+        elif args.benchmark == 'memory':
+            bench_memory(path)
+        elif args.benchmark == 'suite':
+            if bench_suite(path, configs, args.repeat, args.results_json, args.baseline, args.tolerance):
+                sys.exit(1)
+    finally:
+        if tmp is not None:
+            os.unlink(tmp.name)
+
+if __name__ == '__main__':
+    main()